@@ -3,9 +3,14 @@ from cogs.utils import checks
 from .utils.dataIO import dataIO
 import os
 import aiohttp
+import asyncio
 import json
+import time
 
 API_URL = "https://www.cleverbot.com/getreply"
+REQUEST_TIMEOUT = 10 # Seconds
+FAILURE_THRESHOLD = 3 # Consecutive failures that open the circuit
+RESET_TIMEOUT = 30 # Seconds before an open circuit lets a probe through
 
 
 class CleverbotError(Exception):
@@ -26,6 +31,9 @@ class OutOfRequests(CleverbotError):
 class OutdatedCredentials(CleverbotError):
     pass
 
+class CircuitOpen(APIError):
+    pass
+
 
 class Cleverbot():
     """Cleverbot"""
@@ -34,6 +42,7 @@ class Cleverbot():
         self.bot = bot
         self.settings = dataIO.load_json("data/cleverbot/settings.json")
         self.instances = {}
+        self.breaker = CircuitBreaker(FAILURE_THRESHOLD, RESET_TIMEOUT)
 
     @commands.group(no_pm=True, invoke_without_command=True, pass_context=True)
     async def cleverbot(self, ctx, *, message):
@@ -69,7 +78,7 @@ class Cleverbot():
             await self.bot.say("I will reply on mention.")
         else:
             await self.bot.say("I won't reply on mention anymore.")
-        dataIO.save_json("data/cleverbot/settings.json", self.settings)
+        await self.save_settings()
 
     @cleverbot.command()
     @checks.is_owner()
@@ -82,30 +91,106 @@ class Cleverbot():
         self.settings["cleverbot_key"] = key
         self.settings.pop("key", None)
         self.settings.pop("user", None)
-        dataIO.save_json("data/cleverbot/settings.json", self.settings)
+        await self.save_settings()
         await self.bot.say("Credentials set.")
 
+    @cleverbot.command()
+    @checks.is_owner()
+    async def status(self):
+        """Shows whether the API is being contacted"""
+        breaker = self.breaker
+        msg = "Circuit: {}\n".format(breaker.state)
+        msg += "Consecutive failures: {}\n".format(breaker.failures)
+        if breaker.state == "open":
+            remaining = (breaker.opened_at + breaker.reset_timeout -
+                         time.monotonic())
+            if remaining > 0:
+                msg += "Next probe in: {}s\n".format(int(remaining) + 1)
+            else:
+                msg += "Next probe: with the next request\n"
+        elif breaker.state == "half-open":
+            msg += "Probing the API\n"
+        if breaker.error is not None:
+            msg += "Last failure: {}\n".format(breaker.error)
+        msg += "Request timeout: {}s".format(REQUEST_TIMEOUT)
+        await self.bot.say("```\n{}\n```".format(msg))
+
+    async def save_settings(self):
+        settings = dict(self.settings)
+        await self.bot.loop.run_in_executor(None, dataIO.save_json,
+                                            "data/cleverbot/settings.json",
+                                            settings)
+
     async def get_response(self, author, text):
+        metrics = self.get_metrics()
+        if metrics is None:
+            return await self.call_api(author, text)
+        start = time.perf_counter()
+        try:
+            return await self.call_api(author, text)
+        except CleverbotError as e:
+            metrics.inc("cleverbot_errors_total", error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("cleverbot_response_seconds",
+                            time.perf_counter() - start)
+
+    async def call_api(self, author, text):
+        """Requests a response, unless the API has been failing
+
+        After FAILURE_THRESHOLD consecutive errors or timeouts the
+        requests fail right away with CircuitOpen, so that they don't
+        pile up while the API is down"""
+        key = self.get_credentials()
+        if not self.breaker.allow():
+            raise CircuitOpen()
+        try:
+            response = await asyncio.wait_for(
+                self.request_response(author, text, key), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.breaker.failure("timed out")
+            raise APIError()
+        except (APIError, aiohttp.ClientError, ValueError, KeyError) as e:
+            self.breaker.failure(type(e).__name__)
+            raise APIError()
+        except CleverbotError: # The API answered
+            self.breaker.success()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.probing = False
+            raise
+        self.breaker.success()
+        return response
+
+    async def request_response(self, author, text, key):
         payload = {}
-        payload["key"] = self.get_credentials()
+        payload["key"] = key
         payload["cs"] = self.instances.get(author.id, "")
         payload["input"] = text
         session = aiohttp.ClientSession()
 
-        async with session.get(API_URL, params=payload) as r:
-            if r.status == 200:
-                data = await r.text()
-                data = json.loads(data, strict=False)
-                self.instances[author.id] = data["cs"] # Preserves conversation status
-            elif r.status == 401:
-                raise InvalidCredentials()
-            elif r.status == 503:
-                raise OutOfRequests()
-            else:
-                raise APIError()
-        await session.close()
+        try:
+            async with session.get(API_URL, params=payload) as r:
+                if r.status == 200:
+                    data = await r.text()
+                    data = json.loads(data, strict=False)
+                    self.instances[author.id] = data["cs"] # Preserves conversation status
+                elif r.status == 401:
+                    raise InvalidCredentials()
+                elif r.status == 503:
+                    raise OutOfRequests()
+                else:
+                    raise APIError()
+        finally:
+            await session.close()
         return data["output"]
 
+    def get_metrics(self):
+        metrics = self.bot.get_cog("Metrics")
+        if metrics is not None and metrics.enabled:
+            return metrics
+        return None
+
     def get_credentials(self):
         if "cleverbot_key" not in self.settings:
             if "key" in self.settings:
@@ -116,19 +201,21 @@ class Cleverbot():
             raise NoCredentials()
 
     async def on_message(self, message):
+        """Own listener, used when the Dispatch cog isn't loaded"""
         if not self.settings["TOGGLE"] or message.server is None:
             return
 
-        if not self.bot.user_allowed(message):
-            return
+        content = message.content
 
-        author = message.author
-        channel = message.channel
+        # Every mention starts like this, the exact check is done below
+        if not content.startswith("<@"):
+            return
 
         if message.author.id == self.bot.user.id:
             return
 
-        content = message.content
+        if not self.bot.user_allowed(message):
+            return
 
         # I can't just .replace the .mention for a dumb mobile-only bug
         # related to nicknames
@@ -142,8 +229,22 @@ class Cleverbot():
         else:
             return
 
-        await self.bot.send_typing(channel)
-        
+        await self.reply(message, text)
+
+    def dispatch_check(self, ctx):
+        return (self.settings["TOGGLE"] and ctx.server_id is not None and
+                ctx.mention_text is not None and ctx.allowed)
+
+    async def dispatch_message(self, message, ctx):
+        await self.reply(message, ctx.mention_text)
+
+    async def reply(self, message, text):
+        author = message.author
+        channel = message.channel
+
+        if not self.breaker.rejects():
+            await self.bot.send_typing(channel)
+
         try:
             response = await self.get_response(author, text)
         except NoCredentials:
@@ -164,6 +265,57 @@ class Cleverbot():
         else:
             await self.bot.send_message(channel, response)
 
+    def __unload(self):
+        dispatch = self.bot.get_cog("Dispatch")
+        if dispatch is not None:
+            dispatch.unregister(self)
+
+
+class CircuitBreaker:
+    """Keeps track of the API's failures
+
+    closed: requests go through.
+    open: they're rejected, until reset_timeout seconds have passed.
+    half-open: a single request goes through to probe the API. The
+    circuit closes if it works and opens again if it doesn't"""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self.error = None
+        self.probing = False
+
+    def rejects(self):
+        """Whether requests are being rejected without a probe"""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at < self.reset_timeout
+        return self.state == "half-open" and self.probing
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.rejects():
+            return False
+        self.state = "half-open"
+        self.probing = True
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def failure(self, error):
+        self.failures += 1
+        self.error = error
+        self.probing = False
+        if self.state == "half-open" or self.failures >= self.threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
 
 def check_folders():
     if not os.path.exists("data/cleverbot"):
@@ -181,4 +333,8 @@ def check_files():
 def setup(bot):
     check_folders()
     check_files()
-    bot.add_cog(Cleverbot(bot))
+    n = Cleverbot(bot)
+    bot.add_cog(n)
+    dispatch = bot.get_cog("Dispatch")
+    if dispatch is not None:
+        dispatch.register(n)
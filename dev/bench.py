@@ -0,0 +1,198 @@
+"""Replays synthetic messages through the cogs' on_message listeners
+
+    python dev/bench.py --servers 20 --triggers 100 --rifts 10
+
+N servers with M triggers each and K open rifts. The messages are sent
+in random channels by random members: some contain trigger phrases,
+some mention the bot or @everyone, some are commands. Reports, for each
+listener, the latency per message and the throughput, and the time
+spent in the NoMassMentions modifier on the bot's sends.
+
+With --dispatch the Dispatch cog is loaded first and the cogs get the
+messages through it: its line is the whole listener, the cogs' lines
+are the time spent in their dispatch_message.
+
+Runs offline in a temporary folder, see fakes.py."""
+import argparse
+import asyncio
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+
+COGS = ("trigger", "rift", "cleverbot", "nomassmentions")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--triggers", type=int, default=50,
+                        help="triggers per server")
+    parser.add_argument("--rifts", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--regex", type=float, default=0.1,
+                        help="share of regex triggers")
+    parser.add_argument("--seed", type=int, default=26)
+    parser.add_argument("--dispatch", action="store_true",
+                        help="go through the Dispatch cog")
+    return parser.parse_args()
+
+
+def random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase)
+                   for i in range(rng.randint(2, 9)))
+
+
+def populate(bot, modules, args, rng):
+    trigger_mod = modules["trigger"]
+    triggers = bot.get_cog("Trigger")
+    phrases = []
+    for server in bot.servers:
+        owner = server.members[0]
+        for i in range(args.triggers):
+            phrase = "{} {}".format(random_word(rng), random_word(rng))
+            regex = rng.random() < args.regex
+            triggered_by = phrase.replace(" ", r"\s+") if regex else phrase
+            triggers.triggers.append(trigger_mod.TriggerObj(
+                bot=bot, store=triggers.store, name="{}-{}".format(server.id, i),
+                triggered_by=triggered_by, owner=owner.id, server=server.id,
+                responses=["response {}".format(n) for n in range(3)],
+                type=rng.choice(("all", "random")), regex=regex))
+            phrases.append(phrase)
+    triggers.rebuild_index()
+
+    rift = bot.get_cog("Rift")
+    channels = list(bot.get_all_channels())
+    for i in range(args.rifts):
+        source, destination = rng.sample(channels, 2)
+        user = rng.choice(source.server.members)
+        rift.open_rifts["{}-{}".format(user.id, destination.id)] = \
+            modules["rift"].OpenRift(source=source, destination=destination)
+    return phrases
+
+
+def make_messages(bot, phrases, args, rng):
+    messages = []
+    for i in range(args.messages):
+        server = rng.choice(bot.servers)
+        channel = rng.choice(server.channels)
+        author = rng.choice(server.members[:-1]) # Not the bot
+        words = [random_word(rng) for i in range(rng.randint(3, 20))]
+        roll = rng.random()
+        if roll < 0.05:
+            words.insert(rng.randrange(len(words)), rng.choice(phrases))
+        elif roll < 0.06:
+            words.insert(0, bot.user.mention)
+        elif roll < 0.08:
+            words.insert(0, "!" + words[0])
+        elif roll < 0.09:
+            words.append("@everyone")
+        messages.append(fakes.Message(" ".join(words), author, channel))
+    return messages
+
+
+def timed(func, samples):
+    async def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return await func(*args)
+        finally:
+            samples.append(time.perf_counter() - start)
+    wrapper.__self__ = func.__self__ # For FakeBot.remove_cog
+    return wrapper
+
+
+def timed_modifier(func, samples):
+    def wrapper(content):
+        start = time.perf_counter()
+        try:
+            return func(content)
+        finally:
+            samples.append(time.perf_counter() - start)
+    return wrapper
+
+
+def percentile(samples, q):
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+def report(name, samples, messages):
+    if not samples:
+        print("{:<16} no calls".format(name))
+        return
+    samples = sorted(samples)
+    total = sum(samples)
+    print("{:<16} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.0f}".format(
+        name, len(samples), total / len(samples) * 1e6,
+        percentile(samples, 0.5) * 1e6, percentile(samples, 0.99) * 1e6,
+        messages / total if total else float("inf")))
+
+
+async def run(bot, modules, args, rng):
+    cogs = (("dispatch",) if args.dispatch else ()) + COGS
+    for name in cogs:
+        modules[name] = fakes.load_cog(bot, name)
+    await bot.get_cog("Trigger").ready.wait()
+    phrases = populate(bot, modules, args, rng)
+    messages = make_messages(bot, phrases, args, rng)
+
+    samples = defaultdict(list)
+    for event, listeners in bot.listeners.items():
+        listeners[:] = [timed(l, samples[type(l.__self__).__name__])
+                        for l in listeners]
+    dispatch = bot.get_cog("Dispatch")
+    if dispatch is not None:
+        for cog in dispatch.cogs:
+            cog.dispatch_message = timed(cog.dispatch_message,
+                                         samples[type(cog).__name__])
+    modifiers = list(bot.modifiers)
+    bot.modifiers[:] = [timed_modifier(m, samples["NoMassMentions"])
+                        for m in bot.modifiers]
+
+    start = time.perf_counter()
+    for message in messages:
+        await bot.dispatch("message", message)
+    elapsed = time.perf_counter() - start
+
+    print("{} servers, {} triggers each, {} rifts, {} messages{}\n".format(
+        args.servers, args.triggers, args.rifts, len(messages),
+        ", through Dispatch" if dispatch is not None else ""))
+    print("{:<16} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+        "", "calls", "mean us", "p50 us", "p99 us", "msgs/s"))
+    for name in sorted(samples):
+        report(name, samples[name], len(messages))
+    print("\nAll listeners: {:.0f} messages/s, {} sends".format(
+        len(messages) / elapsed, bot.sends))
+
+    bot.modifiers[:] = modifiers
+    for name in list(bot.cogs):
+        bot.remove_cog(name)
+    await asyncio.sleep(0.1)
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    fakes.install()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = fakes.FakeBot(loop)
+    for i in range(args.servers):
+        bot.add_server("server-{}".format(i))
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            loop.run_until_complete(run(bot, {}, args, rng))
+        finally:
+            os.chdir(fakes.REPO)
+            loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+"""Fake discord.py 0.16 and Red v2 objects to run the cogs offline
+
+install() puts fake discord, aiohttp and cogs.utils modules in
+sys.modules. load_cog() then imports a cog of this repository and calls
+its setup() the way Red does, with a FakeBot in place of Red's bot.
+Only what the cogs use is faked: messages are recorded, not sent."""
+import enum
+import importlib.util
+import inspect
+import asyncio
+import itertools
+import json
+import os
+import sys
+import types
+from collections import defaultdict, deque
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_ids = itertools.count(200000000000000000)
+
+
+def new_id():
+    return str(next(_ids))
+
+
+# discord
+
+class Snowflake:
+    def __init__(self, id=None):
+        self.id = id or new_id()
+
+    def __eq__(self, other):
+        return isinstance(other, Snowflake) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class User(Snowflake):
+    def __init__(self, id=None, name="user", discriminator="0001", bot=False):
+        super().__init__(id)
+        self.name = name
+        self.discriminator = discriminator
+        self.bot = bot
+
+    @property
+    def mention(self):
+        return "<@{}>".format(self.id)
+
+    def __str__(self):
+        return "{}#{}".format(self.name, self.discriminator)
+
+
+class Member(User):
+    def __init__(self, user, server, roles=None):
+        super().__init__(user.id, user.name, user.discriminator, user.bot)
+        self.server = server
+        self.roles = roles or []
+        self.nick = None
+        self.game = None
+        self.status = Status.online
+
+
+class Role(Snowflake):
+    def __init__(self, server, name, id=None):
+        super().__init__(id)
+        self.server = server
+        self.name = name
+
+
+class ChannelType(enum.Enum):
+    text = 0
+    private = 1
+    voice = 2
+
+
+class Status(enum.Enum):
+    online = "online"
+    idle = "idle"
+    dnd = "dnd"
+
+
+class Channel(Snowflake):
+    def __init__(self, server, name, id=None, type=ChannelType.text):
+        super().__init__(id)
+        self.server = server
+        self.name = name
+        self.type = type
+        self.is_private = False
+
+    @property
+    def mention(self):
+        return "<#{}>".format(self.id)
+
+    def __str__(self):
+        return self.name
+
+
+class Server(Snowflake):
+    def __init__(self, name, id=None):
+        super().__init__(id)
+        self.name = name
+        self.channels = []
+        self.members = []
+        self.roles = [Role(self, "@everyone", self.id)]
+        self.me = None
+
+    def get_member(self, user_id):
+        return get(self.members, id=user_id)
+
+    def get_channel(self, channel_id):
+        return get(self.channels, id=channel_id)
+
+    def __str__(self):
+        return self.name
+
+
+class Game:
+    def __init__(self, name=None, **kwargs):
+        self.name = name
+
+    def __str__(self):
+        return str(self.name)
+
+
+class Embed:
+    def __init__(self, **kwargs):
+        self.data = kwargs
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+class Message(Snowflake):
+    def __init__(self, content, author, channel, attachments=None,
+                 embeds=None):
+        super().__init__()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = getattr(channel, "server", None)
+        self.attachments = attachments or []
+        self.embeds = embeds or []
+        self.mentions = []
+
+
+class DiscordException(Exception):
+    pass
+
+
+class HTTPException(DiscordException):
+    def __init__(self, response=None, message=""):
+        super().__init__(message)
+        self.response = response
+
+
+class Forbidden(HTTPException):
+    pass
+
+
+class NotFound(HTTPException):
+    pass
+
+
+def get(iterable, **attrs):
+    for item in iterable:
+        if all(getattr(item, k) == v for k, v in attrs.items()):
+            return item
+    return None
+
+
+# discord.ext.commands
+
+def _command(*args, **kwargs):
+    def decorator(func):
+        func.command = _command
+        func.group = _command
+        return func
+    return decorator
+
+
+# cogs.utils
+
+class DataIO:
+    def save_json(self, filename, data):
+        tmp = filename + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+        os.replace(tmp, filename)
+
+    def load_json(self, filename):
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+
+    def is_valid_json(self, filename):
+        try:
+            self.load_json(filename)
+        except (OSError, ValueError):
+            return False
+        return True
+
+
+def _identity_check(*args, **kwargs):
+    return lambda func: func
+
+
+def box(text, lang=""):
+    return "```{}\n{}\n```".format(lang, text)
+
+
+def escape(text, *, mass_mentions=False, formatting=False):
+    if mass_mentions:
+        text = escape_mass_mentions(text)
+    return text
+
+
+def escape_mass_mentions(text):
+    return text.replace("@everyone", "@\u200beveryone")\
+               .replace("@here", "@\u200bhere")
+
+
+def pagify(text, delims=["\n"], *, escape=True, shorten_by=8,
+           page_length=2000):
+    page_length -= shorten_by
+    while len(text) > page_length:
+        cut = max(text.rfind(d, 0, page_length) for d in delims)
+        cut = cut if cut > 0 else page_length
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
+
+
+# aiohttp
+
+class ClientError(Exception):
+    pass
+
+
+class ClientSession:
+    """Fails every request: the harness never touches the network"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get(self, *args, **kwargs):
+        return _FailedRequest()
+
+    async def close(self):
+        pass
+
+
+class _FailedRequest:
+    async def __aenter__(self):
+        raise ClientError("no network in the fake harness")
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Puts the fake modules in sys.modules"""
+    errors = _module("discord.errors", DiscordException=DiscordException,
+                     HTTPException=HTTPException, Forbidden=Forbidden,
+                     NotFound=NotFound)
+    utils = _module("discord.utils", get=get)
+    commands = _module("discord.ext.commands", command=_command,
+                       group=_command)
+    ext = _module("discord.ext", commands=commands)
+    _module("discord", User=User, Member=Member, Role=Role, Channel=Channel,
+            Server=Server, Message=Message, Game=Game, Embed=Embed,
+            Status=Status, ChannelType=ChannelType, errors=errors,
+            utils=utils, ext=ext, HTTPException=HTTPException,
+            Forbidden=Forbidden, NotFound=NotFound)
+    _module("aiohttp", ClientSession=ClientSession, ClientError=ClientError)
+    checks = _module("cogs.utils.checks", is_owner=_identity_check,
+                     admin=_identity_check, mod=_identity_check,
+                     admin_or_permissions=_identity_check,
+                     mod_or_permissions=_identity_check,
+                     serverowner_or_permissions=_identity_check)
+    data_io = _module("cogs.utils.dataIO", dataIO=DataIO())
+    formatting = _module("cogs.utils.chat_formatting", box=box,
+                         escape=escape, pagify=pagify,
+                         escape_mass_mentions=escape_mass_mentions)
+    cogs_utils = _module("cogs.utils", checks=checks, dataIO=data_io,
+                         chat_formatting=formatting)
+    cogs_utils.__path__ = []
+    cogs = _module("cogs", utils=cogs_utils)
+    cogs.__path__ = []
+
+
+def load_cog(bot, name):
+    """Imports REPO/name/name.py as cogs.name and runs its setup()"""
+    path = os.path.join(REPO, name, name + ".py")
+    spec = importlib.util.spec_from_file_location("cogs." + name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    module.setup(bot)
+    return module
+
+
+# Red
+
+class Settings:
+    def __init__(self, owner):
+        self.owner = owner
+        self.co_owners = []
+
+    def get_server_admin(self, server):
+        return "Admin"
+
+    def get_server_mod(self, server):
+        return "Moderator"
+
+
+class FakeBot:
+    """Stands in for Red's bot: sends are recorded, listeners are kept"""
+
+    def __init__(self, loop, prefixes=("!",)):
+        self.loop = loop
+        self.user = User(name="Red", bot=True)
+        self.settings = Settings(new_id())
+        self.command_prefix = list(prefixes)
+        self.servers = []
+        self.cogs = {}
+        self.listeners = defaultdict(list)
+        self.modifiers = []
+        self.sent = deque(maxlen=1000)
+        self.sends = 0
+
+    def add_server(self, name, channels=2, members=10):
+        server = Server(name)
+        server.channels = [Channel(server, "channel-{}".format(i))
+                           for i in range(channels)]
+        server.members = [Member(User(name="member-{}".format(i)), server)
+                          for i in range(members)]
+        server.me = Member(self.user, server)
+        server.members.append(server.me)
+        self.servers.append(server)
+        return server
+
+    def get_all_channels(self):
+        for server in self.servers:
+            yield from server.channels
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+        for name, member in inspect.getmembers(cog):
+            if name.startswith("on_") and inspect.iscoroutinefunction(member):
+                self.add_listener(member, name)
+
+    def remove_cog(self, name):
+        cog = self.cogs.pop(name, None)
+        if cog is None:
+            return
+        for event, listeners in self.listeners.items():
+            listeners[:] = [l for l in listeners if l.__self__ is not cog]
+        unload = getattr(cog, "_{}__unload".format(type(cog).__name__), None)
+        if unload is not None:
+            unload()
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def add_listener(self, func, name=None):
+        self.listeners[name or func.__name__].append(func)
+
+    def remove_listener(self, func, name=None):
+        try:
+            self.listeners[name or func.__name__].remove(func)
+        except ValueError:
+            pass
+
+    async def dispatch(self, event, *args):
+        """Runs the listeners concurrently, one task each like discord.py"""
+        listeners = self.listeners["on_" + event]
+        if listeners:
+            await asyncio.gather(*[listener(*args) for listener in listeners])
+
+    def add_message_modifier(self, func):
+        self.modifiers.append(func)
+
+    def remove_message_modifier(self, func):
+        self.modifiers.remove(func)
+
+    def user_allowed(self, message):
+        return not message.author.bot
+
+    async def wait_until_ready(self):
+        pass
+
+    async def wait_for_message(self, *args, **kwargs):
+        return None
+
+    async def send_message(self, destination, content=None, *, tts=False,
+                           embed=None):
+        if content is not None:
+            content = str(content)
+            for modifier in self.modifiers:
+                content = str(modifier(content))
+        self.sends += 1
+        self.sent.append((destination, content, embed))
+        return Message(content, self.user, destination)
+
+    async def send_file(self, destination, fp, *, filename=None,
+                        content=None):
+        return await self.send_message(destination, content)
+
+    async def say(self, content=None, *args, **kwargs):
+        return await self.send_message(None, content, **kwargs)
+
+    whisper = say
+
+    async def send_typing(self, destination):
+        pass
+
+    async def send_cmd_help(self, ctx):
+        pass
+
+    async def change_presence(self, *, game=None, status=None, afk=False):
+        for server in self.servers:
+            server.me.game = game
+            if status is not None:
+                server.me.status = status
+
+    async def add_roles(self, member, *roles):
+        member.roles.extend(roles)
+
+    async def delete_message(self, message):
+        pass
+
+    async def delete_messages(self, messages):
+        pass
+
+    async def edit_message(self, message, new_content=None, **kwargs):
+        message.content = new_content
+        return message
@@ -0,0 +1,105 @@
+import asyncio
+import traceback
+
+
+class MessageContext:
+    """What the cogs look at in a message, worked out once for all of them"""
+
+    __slots__ = ("server_id", "channel_id", "lowered", "is_command",
+                 "mention_text", "_allowed", "_bot", "_message")
+
+    def __init__(self, dispatch, message):
+        bot = dispatch.bot
+        content = message.content
+        self.server_id = message.server.id if message.server else None
+        self.channel_id = message.channel.id
+        self.lowered = content.lower()
+        self.is_command = content.startswith(dispatch.get_prefixes(message))
+        self.mention_text = None # What follows a mention of the bot
+        if content.startswith("<@"):
+            for mention in ("<@{}>".format(bot.user.id),
+                            "<@!{}>".format(bot.user.id)):
+                if content.startswith(mention):
+                    self.mention_text = content[len(mention):].strip()
+                    break
+        self._allowed = None
+        self._bot = bot
+        self._message = message
+
+    @property
+    def allowed(self):
+        """Whether the bot's settings let the author use it, checked once"""
+        if self._allowed is None:
+            self._allowed = self._bot.user_allowed(self._message)
+        return self._allowed
+
+
+class Dispatch:
+    """Hands messages to the other cogs from a single listener
+
+    Cogs take part by defining dispatch_check(ctx), a cheap filter, and
+    dispatch_message(message, ctx). The context is made once per message
+    and the cogs whose filter passes run concurrently, like separate
+    listeners would. The cogs keep their own on_message, which is put
+    back when this cog is unloaded"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.cogs = []
+        self.prefixes = {}
+        for cog in list(bot.cogs.values()):
+            self.register(cog)
+
+    def register(self, cog):
+        """Takes over the cog's on_message, called by the cogs' setup"""
+        if hasattr(cog, "dispatch_check") and cog not in self.cogs:
+            self.bot.remove_listener(cog.on_message, "on_message")
+            self.cogs.append(cog)
+
+    def unregister(self, cog):
+        """Called by the cogs when they're unloaded"""
+        if cog in self.cogs:
+            self.cogs.remove(cog)
+
+    def get_prefixes(self, message):
+        if callable(self.bot.command_prefix):
+            prefixes = self.bot.command_prefix(self.bot, message)
+        else:
+            prefixes = self.bot.command_prefix
+        # Same as Trigger: the tuple is rebuilt only for a new object
+        key = message.server.id if message.server else None
+        cached = self.prefixes.get(key)
+        if cached is None or cached[0] is not prefixes:
+            if isinstance(prefixes, str):
+                as_tuple = (prefixes,)
+            else:
+                as_tuple = tuple(prefixes)
+            cached = self.prefixes[key] = (prefixes, as_tuple)
+        return cached[1]
+
+    async def on_message(self, message):
+        if not self.cogs or message.author == self.bot.user:
+            return
+        ctx = MessageContext(self, message)
+        handlers = [self.run(cog.dispatch_message(message, ctx))
+                    for cog in self.cogs if cog.dispatch_check(ctx)]
+        if len(handlers) == 1:
+            await handlers[0]
+        elif handlers:
+            await asyncio.gather(*handlers)
+
+    async def run(self, coro):
+        """Keeps a cog's error from reaching the others"""
+        try:
+            await coro
+        except Exception:
+            traceback.print_exc()
+
+    def __unload(self):
+        for cog in self.cogs:
+            self.bot.add_listener(cog.on_message, "on_message")
+        self.cogs = []
+
+
+def setup(bot):
+    bot.add_cog(Dispatch(bot))
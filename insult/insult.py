@@ -1,6 +1,6 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import fileIO
+from .utils.dataIO import dataIO
 from random import choice as randchoice
 import os
 
@@ -10,7 +10,7 @@ class Insult:
     """Airenkun's Insult Cog"""
     def __init__(self, bot):
         self.bot = bot
-        self.insults = fileIO("data/insult/insults.json","load")
+        self.insults = dataIO.load_json("data/insult/insults.json")
 
     @commands.command(pass_context=True, no_pm=True)
     async def insult(self, ctx, user : discord.Member=None):
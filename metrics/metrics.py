@@ -0,0 +1,478 @@
+import os
+import sys
+import time
+import asyncio
+import datetime
+import threading
+import traceback
+from bisect import bisect_left
+from collections import deque, defaultdict
+from discord.ext import commands
+from cogs.utils import checks
+from cogs.utils.dataIO import dataIO
+from cogs.utils.chat_formatting import box, pagify
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+EXPORT_PATH = "data/metrics/metrics.prom"
+STALLS_PATH = "data/metrics/stalls.txt"
+WATCHDOG_TICK = 0.05 # Seconds between heartbeats of the event loop
+DEFAULT_STALL_THRESHOLD = 0.25 # Seconds
+STALLS_SIZE = 50 # Stalls kept in memory
+STACK_LIMIT = 40 # Frames kept per stall
+PROFILE_INTERVAL = 0.01 # Seconds between samples
+MAX_PROFILE_TIME = 600 # Seconds
+# Modules of this repository's cogs, as Red loads them
+COGS = frozenset("cogs." + name for name in (
+    "cleverbot", "dispatch", "insult", "metrics", "nomassmentions",
+    "penis", "remindme", "rift", "rndstatus", "stickyroles", "trigger"))
+PROFILED = COGS - {"cogs.metrics"}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q quantile falls in"""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of 26-Cogs' hot paths
+
+    Other cogs report to this one only while it's loaded and enabled"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = dataIO.load_json("data/metrics/settings.json")
+        self.enabled = self.settings["ENABLED"]
+        self.clear()
+        self.threshold = self.settings.get("STALL_THRESHOLD",
+                                           DEFAULT_STALL_THRESHOLD)
+        self.stalls = deque(maxlen=STALLS_SIZE)
+        self.watchdog = None
+        self.heartbeat_task = None
+        if self.enabled:
+            self.start_watchdog()
+        self.profiler = None
+
+    @commands.group(pass_context=True)
+    @checks.is_owner()
+    async def metrics(self, ctx):
+        """Hot path metrics"""
+        if ctx.invoked_subcommand is None:
+            await self.bot.send_cmd_help(ctx)
+
+    @metrics.command()
+    async def toggle(self):
+        """Enables / disables the collection of metrics"""
+        self.enabled = not self.enabled
+        self.settings["ENABLED"] = self.enabled
+        if self.enabled:
+            self.start_watchdog()
+        else:
+            self.stop_watchdog()
+        await self.save_settings()
+        if self.enabled:
+            await self.bot.say("Metrics are now being collected.")
+        else:
+            await self.bot.say("Metrics won't be collected anymore.")
+
+    @metrics.command(name="show")
+    async def _show(self, *, prefix: str=""):
+        """Shows a summary of the metrics
+
+        Can be filtered by name, e.g. [p]metrics show trigger"""
+        msg = self.summary(prefix)
+        if not msg:
+            await self.bot.say("No metrics collected yet.")
+            return
+        for page in pagify(msg, shorten_by=16):
+            await self.bot.say(box(page))
+
+    @metrics.command()
+    async def export(self):
+        """Writes the metrics to data/metrics in Prometheus' text format"""
+        await self.bot.loop.run_in_executor(None, write_text, EXPORT_PATH,
+                                            self.to_prometheus())
+        await self.bot.say("Metrics exported to `{}`.".format(EXPORT_PATH))
+
+    @metrics.command()
+    async def reset(self):
+        """Resets all the metrics"""
+        self.clear()
+        await self.bot.say("Metrics have been reset.")
+
+    @metrics.group(pass_context=True)
+    async def stalls(self, ctx):
+        """Event loop stalls, attributed to the cog code that caused them"""
+        if ctx.invoked_subcommand is None:
+            await self.bot.send_cmd_help(ctx)
+
+    @stalls.command(name="show")
+    async def stalls_show(self, n: int=10):
+        """Shows the most recent stalls"""
+        stalls = list(self.stalls)[-n:]
+        if not stalls and not self.enabled:
+            await self.bot.say("Metrics are disabled, the event loop isn't "
+                               "being watched.")
+            return
+        if not stalls:
+            await self.bot.say("No stalls over {}ms so far."
+                               "".format(format_ms(self.threshold)))
+            return
+        msg = ""
+        for stall in reversed(stalls):
+            msg += "{} {:>8}ms {}\n".format(format_time(stall["time"]),
+                                            format_ms(stall["duration"]),
+                                            stall["cog"] or "(not a cog)")
+        for page in pagify(msg, shorten_by=16):
+            await self.bot.say(box(page))
+
+    @stalls.command(name="dump")
+    async def stalls_dump(self):
+        """Writes the stalls and their stacks to data/metrics"""
+        text = ""
+        for stall in self.stalls:
+            text += "{} {}ms {}\n{}\n".format(format_time(stall["time"]),
+                                              format_ms(stall["duration"]),
+                                              stall["cog"] or "(not a cog)",
+                                              "".join(stall["stack"]))
+        await self.bot.loop.run_in_executor(None, write_text, STALLS_PATH,
+                                            text)
+        await self.bot.say("{} stalls written to `{}`."
+                           "".format(len(self.stalls), STALLS_PATH))
+
+    @stalls.command(name="threshold")
+    async def stalls_threshold(self, milliseconds: int):
+        """Sets how long the event loop must be blocked to log a stall"""
+        if milliseconds < WATCHDOG_TICK * 1000:
+            await self.bot.say("It can't be lower than {}ms."
+                               "".format(format_ms(WATCHDOG_TICK)))
+            return
+        self.threshold = milliseconds / 1000
+        if self.watchdog is not None:
+            self.watchdog.threshold = self.threshold
+        self.settings["STALL_THRESHOLD"] = self.threshold
+        await self.save_settings()
+        await self.bot.say("Stalls over {}ms will be logged."
+                           "".format(milliseconds))
+
+    @metrics.command()
+    async def profile(self, seconds: int=30):
+        """Samples what the cogs are doing for some seconds
+
+        Only stacks that go through the cogs' code are kept, from the
+        outermost cog frame down. They're written to data/metrics in
+        the collapsed format that flame graph tools take"""
+        if self.profiler is not None:
+            await self.bot.say("A profile is already being taken.")
+            return
+        if not 0 < seconds <= MAX_PROFILE_TIME:
+            await self.bot.say("It must last between 1 and {} seconds."
+                               "".format(MAX_PROFILE_TIME))
+            return
+        # Commands run in the event loop's thread
+        self.profiler = Profiler(threading.get_ident(), PROFILE_INTERVAL)
+        await self.bot.say("Profiling for {} seconds...".format(seconds))
+        self.profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler = self.profiler
+            self.profiler = None
+            profiler.stop()
+        await self.bot.loop.run_in_executor(None, profiler.join)
+        path = "data/metrics/profile-{}.folded".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+        await self.bot.loop.run_in_executor(None, write_text, path,
+                                            profiler.collapsed())
+        in_cogs = sum(profiler.stacks.values())
+        msg = ("{} samples, {} of them in the cogs' code. Written to `{}`."
+               "".format(profiler.samples, in_cogs, path))
+        functions = profiler.top_functions(5)
+        if functions:
+            msg += "\n" + box("\n".join("{:>6} {}".format(n, f)
+                                 for f, n in functions))
+        await self.bot.say(msg)
+
+    async def save_settings(self):
+        settings = dict(self.settings)
+        await self.bot.loop.run_in_executor(None, dataIO.save_json,
+                                            "data/metrics/settings.json",
+                                            settings)
+
+    def start_watchdog(self):
+        """The watchdog and the heartbeat only run while enabled"""
+        if self.watchdog is not None:
+            return
+        self.watchdog = Watchdog(self.threshold, self.stalls)
+        self.watchdog.start()
+        self.heartbeat_task = self.bot.loop.create_task(
+            self.heartbeat(self.watchdog))
+
+    def stop_watchdog(self):
+        if self.watchdog is None:
+            return
+        self.heartbeat_task.cancel()
+        self.watchdog.stop()
+        self.heartbeat_task = self.watchdog = None
+
+    async def heartbeat(self, watchdog):
+        """Lets the watchdog know that the event loop isn't blocked"""
+        watchdog.loop_thread = threading.get_ident()
+        try:
+            while True:
+                expected = time.monotonic() + WATCHDOG_TICK
+                watchdog.expected = expected
+                await asyncio.sleep(WATCHDOG_TICK)
+                self.observe("event_loop_lag_seconds",
+                             max(time.monotonic() - expected, 0))
+        except asyncio.CancelledError:
+            pass
+
+    def clear(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def summary(self, prefix=""):
+        msg = ""
+        for key, value in sorted(self.counters.items()):
+            if key[0].startswith(prefix):
+                msg += "{} {}\n".format(format_key(key), value)
+        for key, value in sorted(self.gauges.items()):
+            if key[0].startswith(prefix):
+                msg += "{} {}\n".format(format_key(key), value)
+        for key, h in sorted(self.histograms.items()):
+            if key[0].startswith(prefix) and h.count:
+                msg += ("{} n={} avg={:.2f}ms p50<={}ms p95<={}ms\n"
+                        "".format(format_key(key), h.count,
+                                  h.sum / h.count * 1000,
+                                  format_ms(h.quantile(0.5)),
+                                  format_ms(h.quantile(0.95))))
+        return msg
+
+    def to_prometheus(self):
+        lines = []
+        for kind, items in (("counter", self.counters),
+                            ("gauge", self.gauges)):
+            for name in sorted({k[0] for k in items}):
+                lines.append("# TYPE {} {}".format(name, kind))
+                for key, value in sorted(items.items()):
+                    if key[0] == name:
+                        lines.append("{} {}".format(format_key(key), value))
+        for name in sorted({k[0] for k in self.histograms}):
+            lines.append("# TYPE {} histogram".format(name))
+            for key, h in sorted(self.histograms.items()):
+                if key[0] != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    labels = key[1] + (("le", le),)
+                    lines.append("{} {}".format(
+                        format_key((name + "_bucket", labels)), cumulative))
+                lines.append("{} {}".format(
+                    format_key((name + "_sum", key[1])), h.sum))
+                lines.append("{} {}".format(
+                    format_key((name + "_count", key[1])), h.count))
+        return "\n".join(lines) + "\n"
+
+    def __unload(self):
+        self.stop_watchdog()
+        if self.profiler is not None:
+            self.profiler.stop()
+
+
+class Watchdog(threading.Thread):
+    """Logs the stack of the event loop when it's blocked for too long
+
+    The event loop sets the time of its next heartbeat every
+    WATCHDOG_TICK seconds. If the heartbeat is late by more than the
+    threshold, the loop's thread is still running the code that blocks
+    it, so its stack is taken from here"""
+
+    def __init__(self, threshold, stalls):
+        super().__init__(name="metrics-watchdog", daemon=True)
+        self.threshold = threshold
+        self.stalls = stalls # Kept by the cog, across restarts
+        self.loop_thread = None
+        self.expected = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        stall = None
+        while not self.stopped.wait(WATCHDOG_TICK):
+            expected = self.expected
+            if expected is None:
+                continue
+            lag = time.monotonic() - expected
+            if lag < self.threshold:
+                stall = None
+            elif stall is not None and stall["expected"] == expected:
+                stall["duration"] = lag
+            else:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is None:
+                    continue
+                stall = {"expected": expected, "time": time.time(),
+                         "duration": lag, "cog": cog_function(frame),
+                         "stack": traceback.format_list(
+                             traceback.extract_stack(frame, STACK_LIMIT))}
+                self.stalls.append(stall)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Profiler(threading.Thread):
+    """Samples the stacks of every thread until it's stopped
+
+    The samples are aggregated as they're taken, so memory only grows
+    with the number of distinct stacks"""
+
+    def __init__(self, loop_thread, interval):
+        super().__init__(name="metrics-profiler", daemon=True)
+        self.loop_thread = loop_thread
+        self.interval = interval
+        self.stacks = defaultdict(int) # Collapsed stack -> samples
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            for thread, frame in sys._current_frames().items():
+                if thread == me:
+                    continue
+                stack = cog_stack(frame)
+                if stack:
+                    root = "loop" if thread == self.loop_thread else "thread"
+                    self.stacks[root + ";" + stack] += 1
+
+    def stop(self):
+        self.stopped.set()
+
+    def collapsed(self):
+        return "".join("{} {}\n".format(stack, n)
+                       for stack, n in sorted(self.stacks.items()))
+
+    def top_functions(self, n):
+        """Returns the cog functions that were sampled the most"""
+        cogs = {module[5:] for module in PROFILED}
+        functions = defaultdict(int)
+        for stack, samples in self.stacks.items():
+            for function in set(stack.split(";")):
+                if function.split(":")[0] in cogs:
+                    functions[function] += samples
+        return sorted(functions.items(), key=lambda f: f[1],
+                      reverse=True)[:n]
+
+
+def cog_stack(frame):
+    """Collapses a stack as module:function;... from its outermost cog frame
+
+    Returns None if none of the frames are the cogs'"""
+    names = []
+    outermost = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "?")
+        if module in PROFILED:
+            module = module[5:]
+            outermost = len(names)
+        names.append("{}:{}".format(module, frame.f_code.co_name))
+        frame = frame.f_back
+    if outermost is None:
+        return None
+    return ";".join(reversed(names[:outermost + 1]))
+
+
+def cog_function(frame):
+    """Returns the innermost frame of the cogs as module:function:line"""
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+        if module in COGS:
+            return "{}:{}:{}".format(module[5:], frame.f_code.co_name,
+                                     frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def write_text(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    labels = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                      for k, v in labels)
+    return "{}{{{}}}".format(name, labels)
+
+
+def format_ms(seconds):
+    if seconds == float("inf"):
+        return "inf"
+    return "{:g}".format(round(seconds * 1000, 1))
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%d/%m %H:%M:%S")
+
+
+def check_folders():
+    if not os.path.exists("data/metrics"):
+        print("Creating data/metrics folder...")
+        os.makedirs("data/metrics")
+
+
+def check_files():
+    f = "data/metrics/settings.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating empty settings.json...")
+        dataIO.save_json(f, {"ENABLED": True})
+
+
+def setup(bot):
+    check_folders()
+    check_files()
+    bot.add_cog(Metrics(bot))
@@ -1,13 +1,36 @@
+import re
+
+# Each pattern must match only the @ of the mention it targets
+MASS_MENTIONS = r"@(?=everyone|here)"
+ROLE_MENTIONS = r"(?<=<)@(?=&\d+>)"
+
+
+class MentionScrubber:
+    """Breaks mentions by putting a zero width space after their @
+
+    All the patterns are compiled into a single one so that a message is
+    scanned only once, and messages without any @ aren't scanned at all"""
+
+    def __init__(self, patterns=(MASS_MENTIONS,)):
+        self.pattern = re.compile("|".join("(?:{})".format(p)
+                                           for p in patterns))
+
+    def __call__(self, m):
+        if "@" not in m:
+            return m
+        return self.pattern.sub("@\u200b", m)
+
+
 class NoMassMentions:
     """Silences outcoming mass mentions"""
 
     def __init__(self, bot):
         self.bot = bot
+        self.scrubber = MentionScrubber()
         self.bot.add_message_modifier(self.cleanse_msg)
 
     def cleanse_msg(self, m):
-        return m.replace("@everyone", "@\u200beveryone")\
-                .replace("@here", "@\u200bhere")
+        return self.scrubber(m)
 
     def __unload(self):
         self.bot.remove_message_modifier(self.cleanse_msg)
@@ -15,3 +38,36 @@ class NoMassMentions:
 
 def setup(bot):
     bot.add_cog(NoMassMentions(bot))
+
+
+if __name__ == "__main__":
+    # Microbenchmark: python nomassmentions.py
+    import random
+    import string
+    import timeit
+
+    def replace_twice(m):
+        return m.replace("@everyone", "@\u200beveryone")\
+                .replace("@here", "@\u200bhere")
+
+    random.seed(26)
+    words = ["".join(random.choice(string.ascii_lowercase)
+                     for i in range(random.randint(2, 9)))
+             for i in range(5000)]
+    text = " ".join(words)
+    # Pages as they'd come out of pagify
+    pages = {
+        "no @": [text[i:i + 2000] for i in range(0, len(text), 2000)],
+        "@user": [text[i:i + 1990] + " @user" for i in range(0, len(text), 1990)],
+        "@everyone": [text[i:i + 1980] + " @everyone @here"
+                      for i in range(0, len(text), 1980)]
+    }
+    scrubber = MentionScrubber()
+    for name, sample in pages.items():
+        assert [scrubber(p) for p in sample] == [replace_twice(p) for p in sample]
+        print("{}:".format(name))
+        for label, func in (("str.replace x2", replace_twice),
+                            ("MentionScrubber", scrubber)):
+            t = timeit.timeit(lambda: [func(p) for p in sample], number=2000)
+            mb = 2000 * sum(len(p) for p in sample) / t / 1024 / 1024
+            print("    {:<16} {:8.1f} MB/s".format(label, mb))
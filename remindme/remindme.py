@@ -1,17 +1,30 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import fileIO
+from .utils.dataIO import dataIO
 import os
 import asyncio
 import time
 import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+REMINDERS_PATH = "data/remindme/reminders.json"
+REMINDERS_DB = "data/remindme/reminders.db"
+LEASE = 60 # Seconds a shard has to deliver the reminders it claimed
 
 class RemindMe:
     """Never forget anything anymore."""
 
     def __init__(self, bot):
         self.bot = bot
-        self.reminders = fileIO("data/remindme/reminders.json", "load")
+        shard = getattr(bot, "shard_id", None) or 0
+        self.store = ReminderStore(REMINDERS_DB,
+                                   "{}-{}".format(shard, os.getpid()))
+        # A single thread, so that the connection is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.ready = asyncio.Event()
+        self.load_task = bot.loop.create_task(self.load_reminders())
+        self.check_task = bot.loop.create_task(self.check_reminders())
         self.units = {"minute" : 60, "hour" : 3600, "day" : 86400, "week": 604800, "month": 2592000}
 
     @commands.command(pass_context=True)
@@ -21,6 +34,10 @@ class RemindMe:
         Accepts: minutes, hours, days, weeks, month
         Example:
         [p]remindme 3 days Have sushi with Asu and JennJenn"""
+        await self.ready.wait()
+        if self.store.db is None:
+            await self.bot.say("The reminders' database couldn't be opened.")
+            return
         time_unit = time_unit.lower()
         author = ctx.message.author
         s = ""
@@ -38,69 +55,223 @@ class RemindMe:
             return
         seconds = self.units[time_unit] * quantity
         future = int(time.time()+seconds)
-        self.reminders.append({"ID" : author.id, "FUTURE" : future, "TEXT" : text})
+        await self.run(self.store.add, author.id, future, text)
         logger.info("{} ({}) set a reminder.".format(author.name, author.id))
         await self.bot.say("I will remind you that in {} {}.".format(str(quantity), time_unit + s))
-        fileIO("data/remindme/reminders.json", "save", self.reminders)
 
     @commands.command(pass_context=True)
     async def forgetme(self, ctx):
         """Removes all your upcoming notifications"""
+        await self.ready.wait()
+        if self.store.db is None:
+            await self.bot.say("The reminders' database couldn't be opened.")
+            return
         author = ctx.message.author
-        to_remove = []
-        for reminder in self.reminders:
-            if reminder["ID"] == author.id:
-                to_remove.append(reminder)
-
-        if not to_remove == []:
-            for reminder in to_remove:
-                self.reminders.remove(reminder)
-            fileIO("data/remindme/reminders.json", "save", self.reminders)
+        removed = await self.run(self.store.forget, author.id)
+
+        if removed:
             await self.bot.say("All your notifications have been removed.")
         else:
             await self.bot.say("You don't have any upcoming notification.")
 
     async def check_reminders(self):
-        while self is self.bot.get_cog("RemindMe"):
-            to_remove = []
-            for reminder in self.reminders:
-                if reminder["FUTURE"] <= int(time.time()):
-                    try:
-                        await self.bot.send_message(discord.User(id=reminder["ID"]), "You asked me to remind you this:\n{}".format(reminder["TEXT"]))
-                    except (discord.errors.Forbidden, discord.errors.NotFound):
-                        to_remove.append(reminder)
-                    except discord.errors.HTTPException:
-                        pass
-                    else:
-                        to_remove.append(reminder)
-            for reminder in to_remove:
-                self.reminders.remove(reminder)
-            if to_remove:
-                fileIO("data/remindme/reminders.json", "save", self.reminders)
-            await asyncio.sleep(5)
+        try:
+            await self.ready.wait()
+            if self.store.db is None:
+                return
+            while True:
+                try:
+                    await self.send_reminders()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("RemindMe: couldn't check the reminders: "
+                          "{}".format(e))
+                await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            pass
+
+    async def send_reminders(self):
+        """Sends the due reminders this shard could lease
+
+        Each lease is renewed right before its reminder is sent. If the
+        previous sends took longer than LEASE another shard may have
+        claimed it since, then it's skipped"""
+        metrics = self.get_metrics()
+        if metrics is not None:
+            start = time.perf_counter()
+            metrics.gauge("remindme_reminders",
+                          await self.run(self.store.count))
+        reminders = await self.run(self.store.claim, int(time.time()))
+        for reminder_id, user_id, future, text in reminders:
+            if not await self.run(self.store.renew, reminder_id,
+                                  int(time.time())):
+                continue
+            try:
+                await self.bot.send_message(discord.User(id=user_id), "You asked me to remind you this:\n{}".format(text))
+            except (discord.errors.Forbidden, discord.errors.NotFound):
+                await self.run(self.store.done, reminder_id)
+            except discord.errors.HTTPException:
+                await self.run(self.store.release, reminder_id)
+            else:
+                await self.run(self.store.done, reminder_id)
+                if metrics is not None:
+                    metrics.observe("remindme_lag_seconds",
+                                    time.time() - future)
+        if metrics is not None:
+            metrics.observe("remindme_check_seconds",
+                            time.perf_counter() - start)
+
+    async def load_reminders(self):
+        """Opens the database, commands wait for this to be done
+
+        If it can't be opened they say so instead. A failed import of
+        reminders.json is rolled back and tried again on the next load"""
+        try:
+            await self.run(self.store.open)
+        except Exception as e:
+            print("RemindMe: couldn't open the reminders' database: "
+                  "{}".format(e))
+        else:
+            try:
+                await self.run(self.store.migrate, REMINDERS_PATH)
+            except Exception as e:
+                print("RemindMe: couldn't import reminders.json: "
+                      "{}".format(e))
+        finally:
+            self.ready.set()
+
+    def run(self, func, *args):
+        return self.bot.loop.run_in_executor(self.executor, func, *args)
+
+    def get_metrics(self):
+        metrics = self.bot.get_cog("Metrics")
+        if metrics is not None and metrics.enabled:
+            return metrics
+        return None
+
+    def __unload(self):
+        self.load_task.cancel()
+        self.check_task.cancel()
+        self.executor.submit(self.store.close)
+        self.executor.shutdown(wait=False)
+
+class ReminderStore:
+    """SQLite database of the reminders, shared by every shard
+
+    It runs in WAL mode so that shards can read while another one is
+    writing. A shard leases the due reminders it's about to deliver,
+    so that each of them is only sent once. If the shard doesn't get
+    to deliver them in LEASE seconds another one can claim them"""
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.db = None
+
+    def open(self):
+        """Sets db only once the database is usable"""
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                             check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS reminders "
+                       "(id INTEGER PRIMARY KEY, user_id TEXT, "
+                       "future INTEGER, text TEXT, lease_owner TEXT, "
+                       "lease_until INTEGER)")
+            db.execute("CREATE INDEX IF NOT EXISTS reminders_future "
+                       "ON reminders (future)")
+            db.execute("CREATE INDEX IF NOT EXISTS reminders_user "
+                       "ON reminders (user_id)")
+        except:
+            db.close()
+            raise
+        self.db = db
+
+    def migrate(self, path):
+        """Moves the reminders of the old JSON file into the database"""
+        if not os.path.exists(path):
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            reminders = dataIO.load_json(path)
+            self.db.executemany("INSERT INTO reminders (user_id, future, text) "
+                                "VALUES (?, ?, ?)",
+                                ((r["ID"], r["FUTURE"], r["TEXT"])
+                                 for r in reminders))
+            # Emptied within the transaction so other shards can't
+            # import it again
+            if reminders:
+                dataIO.save_json(path, [])
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def add(self, user_id, future, text):
+        self.db.execute("INSERT INTO reminders (user_id, future, text) "
+                        "VALUES (?, ?, ?)", (user_id, future, text))
+
+    def forget(self, user_id):
+        cursor = self.db.execute("DELETE FROM reminders WHERE user_id = ?",
+                                 (user_id,))
+        return cursor.rowcount
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM reminders").fetchone()[0]
+
+    def claim(self, now):
+        """Leases the due reminders that no other shard is delivering"""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            reminders = self.db.execute(
+                "SELECT id, user_id, future, text FROM reminders "
+                "WHERE future <= ? AND (lease_until IS NULL OR "
+                "lease_until < ?) ORDER BY future LIMIT 100",
+                (now, now)).fetchall()
+            self.db.executemany("UPDATE reminders SET lease_owner = ?, "
+                                "lease_until = ? WHERE id = ?",
+                                ((self.owner, now + LEASE, r[0])
+                                 for r in reminders))
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return reminders
+
+    def renew(self, reminder_id, now):
+        """Extends the lease, returns False if this shard lost it"""
+        cursor = self.db.execute("UPDATE reminders SET lease_until = ? "
+                                 "WHERE id = ? AND lease_owner = ?",
+                                 (now + LEASE, reminder_id, self.owner))
+        return cursor.rowcount == 1
+
+    def done(self, reminder_id):
+        self.db.execute("DELETE FROM reminders WHERE id = ? AND "
+                        "lease_owner = ?", (reminder_id, self.owner))
+
+    def release(self, reminder_id):
+        self.db.execute("UPDATE reminders SET lease_owner = NULL, "
+                        "lease_until = NULL WHERE id = ? AND "
+                        "lease_owner = ?", (reminder_id, self.owner))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
 def check_folders():
     if not os.path.exists("data/remindme"):
         print("Creating data/remindme folder...")
         os.makedirs("data/remindme")
 
-def check_files():
-    f = "data/remindme/reminders.json"
-    if not fileIO(f, "check"):
-        print("Creating empty reminders.json...")
-        fileIO(f, "save", [])
-
 def setup(bot):
     global logger
     check_folders()
-    check_files()
     logger = logging.getLogger("remindme")
     if logger.level == 0: # Prevents the logger from being loaded again in case of module reload
         logger.setLevel(logging.INFO)
         handler = logging.FileHandler(filename='data/remindme/reminders.log', encoding='utf-8', mode='a')
         handler.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt="[%d/%m/%Y %H:%M]"))
         logger.addHandler(handler)
-    n = RemindMe(bot)
-    loop = asyncio.get_event_loop()
-    loop.create_task(n.check_reminders())
-    bot.add_cog(n)
+    bot.add_cog(RemindMe(bot))
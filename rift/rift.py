@@ -1,12 +1,19 @@
 import discord
+import aiohttp
+import asyncio
 from discord.ext import commands
 from collections import namedtuple
+from tempfile import SpooledTemporaryFile
 from cogs.utils.chat_formatting import escape, pagify
 
 # Commission made for ScarletRaven, who decided to make it public
 # for everyone to enjoy 👍
 
 OpenRift = namedtuple("Rift", ["source", "destination"])
+MAX_FILE_SIZE = 8 * 1024 * 1024 # Bytes, bigger attachments aren't relayed
+SPOOL_SIZE = 1024 * 1024 # Bytes of a download kept in memory, the rest is on disk
+CHUNK_SIZE = 64 * 1024
+MAX_DOWNLOADS = 4 # Attachments being downloaded at the same time
 
 
 class Rift:
@@ -15,6 +22,7 @@ class Rift:
     def __init__(self, bot):
         self.bot = bot
         self.open_rifts = {}
+        self.downloads = asyncio.Semaphore(MAX_DOWNLOADS)
 
     @commands.command(pass_context=True)
     async def riftopen(self, ctx, channel):
@@ -77,7 +85,7 @@ class Rift:
                                                   channel=author_channel)
             if msg is not None and msg.content.lower() != "exit":
                 try:
-                    await self.bot.send_message(channel, msg.content)
+                    await self.relay(msg, [channel], msg.content)
                 except:
                     await self.bot.say("Couldn't send your message.")
             else:
@@ -86,14 +94,97 @@ class Rift:
         await self.bot.say("Rift closed.")
 
     async def on_message(self, message):
-        if message.author == self.bot.user:
+        """Own listener, used when the Dispatch cog isn't loaded"""
+        if not self.open_rifts or message.author == self.bot.user:
             return
-        for k, v in self.open_rifts.items():
-            if v.destination == message.channel:
-                msg = "{}: {}".format(message.author, message.content)
-                msg = escape(msg, mass_mentions=True)
-                await self.bot.send_message(v.source, msg)
+        await self.relay_to_sources(message)
+
+    def dispatch_check(self, ctx):
+        return bool(self.open_rifts)
+
+    async def dispatch_message(self, message, ctx):
+        await self.relay_to_sources(message)
+
+    async def relay_to_sources(self, message):
+        sources = [v.source for v in self.open_rifts.values()
+                   if v.destination == message.channel]
+        if sources:
+            msg = "{}: {}".format(message.author, message.content)
+            msg = escape(msg, mass_mentions=True)
+            await self.relay(message, sources, msg)
+
+    async def relay(self, message, channels, content):
+        """Sends the content and the message's attachments and embeds
+
+        Each attachment is downloaded once, whatever the number of
+        channels, to a temporary file that only stays in memory while
+        it's small. That file is then uploaded to every channel"""
+        embeds = [discord.Embed.from_data(e) for e in message.embeds
+                  if e.get("type") == "rich"]
+        files = []
+        if message.attachments:
+            session = aiohttp.ClientSession()
+            try:
+                for attachment in message.attachments:
+                    files.append((attachment["filename"],
+                                  await self.download(session, attachment)))
+            finally:
+                await session.close()
+        try:
+            for channel in channels:
+                if content:
+                    await self.bot.send_message(channel, content)
+                for embed in embeds:
+                    await self.bot.send_message(channel, embed=embed)
+                for filename, f in files:
+                    if f is None:
+                        await self.bot.send_message(channel, "`{}` couldn't "
+                                                    "be relayed.".format(filename))
+                        continue
+                    f.seek(0)
+                    await self.bot.send_file(channel, f, filename=filename)
+        finally:
+            for filename, f in files:
+                if f is not None:
+                    f.close()
+
+    async def download(self, session, attachment):
+        """Downloads an attachment in chunks
+
+        Returns None if it's bigger than MAX_FILE_SIZE or unavailable"""
+        if attachment.get("size", 0) > MAX_FILE_SIZE:
+            return None
+        f = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            async with self.downloads:
+                async with session.get(attachment["url"]) as r:
+                    if r.status != 200:
+                        f.close()
+                        return None
+                    size = 0
+                    while True:
+                        chunk = await r.content.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > MAX_FILE_SIZE:
+                            f.close()
+                            return None
+                        f.write(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            f.close()
+            return None
+        return f
+
+    def __unload(self):
+        dispatch = self.bot.get_cog("Dispatch")
+        if dispatch is not None:
+            dispatch.unregister(self)
 
 
 def setup(bot):
-    bot.add_cog(Rift(bot))
+    n = Rift(bot)
+    bot.add_cog(n)
+    dispatch = bot.get_cog("Dispatch")
+    if dispatch is not None:
+        dispatch.register(n)
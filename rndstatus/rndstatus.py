@@ -1,11 +1,13 @@
 import discord
 from discord.ext import commands
-from .utils.dataIO import fileIO
+from .utils.dataIO import dataIO
 from .utils import checks
 from __main__ import send_cmd_help
-from random import choice as rndchoice
+from random import shuffle
 import os
 import time
+import asyncio
+import copy
 
 class RandomStatus:
     """Cycles random statuses
@@ -15,9 +17,13 @@ class RandomStatus:
 
     def __init__(self, bot):
         self.bot = bot
-        self.settings = fileIO("data/rndstatus/settings.json", "load")
-        self.statuses = fileIO("data/rndstatus/statuses.json", "load")
+        self.settings = dataIO.load_json("data/rndstatus/settings.json")
+        self.statuses = dataIO.load_json("data/rndstatus/statuses.json")
         self.last_change = None
+        self.current = None
+        self.bag = []
+        self.settings_changed = asyncio.Event()
+        self.rotation_task = bot.loop.create_task(self.rotate_statuses())
 
     @commands.group(pass_context=True)
     @checks.is_owner()
@@ -39,8 +45,11 @@ class RandomStatus:
             await self.bot.whisper("Current statuses: " + " | ".join(self.statuses))
             return
         self.statuses = list(statuses)
-        fileIO("data/rndstatus/statuses.json", "save", self.statuses)
+        self.bag = []
+        await self.save_json("data/rndstatus/statuses.json", self.statuses)
         await self.bot.change_presence(status=current_status)
+        self.last_change = None
+        self.settings_changed.set()
         await self.bot.say("Done. Redo this command with no parameters to see the current list of statuses.")
 
 
@@ -53,40 +62,128 @@ class RandomStatus:
             await send_cmd_help(ctx)
             return
         self.settings["DELAY"] = seconds
-        fileIO("data/rndstatus/settings.json", "save", self.settings)
+        await self.save_json("data/rndstatus/settings.json", self.settings)
+        self.settings_changed.set()
         await self.bot.say("Interval set to {}".format(str(seconds)))
 
-    async def switch_status(self, message):
-        if not message.channel.is_private:
-            current_game = str(message.server.me.game)
-            current_status = message.server.me.status
-
-            if self.last_change == None: #first run
-                self.last_change = int(time.perf_counter())
-                if len(self.statuses) > 0 and (current_game in self.statuses or current_game == "None"):
-                    new_game = self.random_status(message)
-                    await self.bot.change_presence(game=discord.Game(name=new_game), status=current_status)
-
-            if message.author.id != self.bot.user.id:
-                if abs(self.last_change - int(time.perf_counter())) >= self.settings["DELAY"]:
-                    self.last_change = int(time.perf_counter())
-                    new_game = self.random_status(message)
-                    if new_game != None:
-                        if current_game != new_game:
-                            if current_game in self.statuses or current_game == "None": #Prevents rndstatus from overwriting song's titles or
-                                await self.bot.change_presence(game=discord.Game(name=new_game), status=current_status) #custom statuses set with !set status
-
-    def random_status(self, msg):
-        current = str(msg.server.me.game)
-        new = str(msg.server.me.game)
-        if len(self.statuses) > 1:
-            while current == new:
-                new = rndchoice(self.statuses)
-        elif len(self.statuses) == 1:
-            new = self.statuses[0]
+    @rndstatus.command()
+    async def weight(self, status : str, weight : int):
+        """Sets how often a status comes up in a rotation
+
+        A status with weight 3 is shown 3 times per rotation.
+        0 excludes it. Defaults to 1."""
+        if status not in self.statuses:
+            await self.bot.say("That status is not in the list.")
+            return
+        if not 0 <= weight <= 100:
+            await self.bot.say("Weight must be between 0 and 100.")
+            return
+        weights = self.settings.setdefault("WEIGHTS", {})
+        if weight == 1:
+            weights.pop(status, None)
         else:
-            new = None
-        return new
+            weights[status] = weight
+        self.bag = []
+        await self.save_json("data/rndstatus/settings.json", self.settings)
+        await self.bot.say("Weight of {} set to {}".format(status, weight))
+
+    @rndstatus.command()
+    async def mintime(self, status : str, seconds : int):
+        """Sets for how long a status is shown at least
+
+        Statuses are never shown for less than the delay.
+        0 reverts it to the delay."""
+        if status not in self.statuses:
+            await self.bot.say("That status is not in the list.")
+            return
+        min_times = self.settings.setdefault("MIN_TIME", {})
+        if seconds > 0:
+            min_times[status] = seconds
+        else:
+            min_times.pop(status, None)
+        await self.save_json("data/rndstatus/settings.json", self.settings)
+        self.settings_changed.set()
+        await self.bot.say("Minimum time of {} set to {}"
+                           "".format(status, str(max(seconds, 0))))
+
+    async def rotate_statuses(self):
+        """Switches status every DELAY seconds
+
+        Sleeps until the next switch is due, waking up early if the
+        statuses or the delay are changed"""
+        await self.bot.wait_until_ready()
+        try:
+            while True:
+                if (self.last_change is None or time.perf_counter() -
+                        self.last_change >= self.get_delay()):
+                    try:
+                        await self.switch_status()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e: # e.g. disconnected, retried later
+                        print("Couldn't switch status: {}".format(e))
+                remaining = (self.last_change + self.get_delay() -
+                             time.perf_counter())
+                try:
+                    await asyncio.wait_for(self.settings_changed.wait(),
+                                           timeout=max(remaining, 0))
+                except asyncio.TimeoutError:
+                    pass
+                self.settings_changed.clear()
+        except asyncio.CancelledError:
+            pass
+
+    async def switch_status(self):
+        self.last_change = time.perf_counter()
+        server = next(iter(self.bot.servers), None)
+        if server is None:
+            return
+        current_game = str(server.me.game)
+        current_status = server.me.status
+
+        new_game = self.random_status(current_game)
+        if new_game != None:
+            if current_game != new_game:
+                if current_game in self.statuses or current_game == "None": #Prevents rndstatus from overwriting song's titles or
+                    await self.bot.change_presence(game=discord.Game(name=new_game), status=current_status) #custom statuses set with !set status
+                    self.current = new_game
+
+    async def save_json(self, path, data):
+        data = copy.deepcopy(data)
+        await self.bot.loop.run_in_executor(None, dataIO.save_json, path, data)
+
+    def get_delay(self):
+        min_time = self.settings.get("MIN_TIME", {}).get(self.current, 0)
+        return max(self.settings["DELAY"], min_time)
+
+    def random_status(self, current):
+        if not self.bag:
+            self.bag = self.fill_bag(current)
+        if not self.bag:
+            return None
+        return self.bag.pop()
+
+    def fill_bag(self, current):
+        """Returns a shuffled rotation of the statuses
+
+        Each status is added as many times as its weight. Popping from
+        the end of it keeps every pick O(1), and a status won't come up
+        more than its weight until the whole bag has been shown. The next
+        pick is swapped out if it's the status currently shown"""
+        weights = self.settings.get("WEIGHTS", {})
+        bag = []
+        for status in self.statuses:
+            bag.extend([status] * weights.get(status, 1))
+        shuffle(bag)
+        if bag and bag[-1] == current:
+            for i, status in enumerate(bag):
+                if status != current:
+                    bag[i], bag[-1] = bag[-1], bag[i]
+                    break
+        return bag
+
+    def __unload(self):
+        self.rotation_task.cancel()
 
 def check_folders():
     if not os.path.exists("data/rndstatus"):
@@ -98,18 +195,16 @@ def check_files():
     default = ["her Turn()", "Tomb Raider II", "Transistor", "NEO Scavenger", "Python", "with your heart."]
 
     f = "data/rndstatus/settings.json"
-    if not fileIO(f, "check"):
+    if not dataIO.is_valid_json(f):
         print("Creating empty settings.json...")
-        fileIO(f, "save", settings)
+        dataIO.save_json(f, settings)
 
     f = "data/rndstatus/statuses.json"
-    if not fileIO(f, "check"):
+    if not dataIO.is_valid_json(f):
         print("Creating empty statuses.json...")
-        fileIO(f, "save", default)
+        dataIO.save_json(f, default)
 
 def setup(bot):
     check_folders()
     check_files()
-    n = RandomStatus(bot)
-    bot.add_listener(n.switch_status, "on_message")
-    bot.add_cog(n)
+    bot.add_cog(RandomStatus(bot))
@@ -1,14 +1,164 @@
 import discord
 import os
+import asyncio
+import time
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from discord.ext import commands
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .utils.dataIO import dataIO
 from .utils import checks
 
-default = {
-    "sticky_roles": [],
-    "to_reapply"  : {}
-}
+JSON_PATH = "data/stickyroles/stickyroles.json"
+SNAPSHOT_PATH = "data/stickyroles/stickyroles.snapshot"
+DB_PATH = "data/stickyroles/stickyroles.db"
+DEFAULT_RETENTION = 60 * 60 * 24 * 180 # Seconds
+DEFAULT_MAX_RECORDS = 10000
+MAX_RECORDS_LIMIT = 100000
+COMPACTION_INTERVAL = 60 * 60 # Seconds
+REAPPLY_WORKERS = 3
+MAX_ATTEMPTS = 5
+
+
+def default_settings():
+    return {
+        "sticky_roles": [],
+        "to_reapply"  : OrderedDict(),
+        "retention"   : DEFAULT_RETENTION,
+        "max_records" : DEFAULT_MAX_RECORDS
+    }
+
+
+def import_settings(data):
+    """Turns the stored settings of a server into their in-memory form
+
+    Departed members are stored as [member_id, left_at, role_id, ...]
+    arrays of integers, oldest first. In memory they're kept in an
+    OrderedDict of member_id -> [left_at, role_id, ...]"""
+    settings = default_settings()
+    settings.update(data)
+    to_reapply = OrderedDict()
+    records = data.get("to_reapply", [])
+    if isinstance(records, dict): # Old format, {member_id: [role_id, ...]}
+        now = int(time.time())
+        records = [[int(m), now] + [int(r) for r in roles]
+                   for m, roles in records.items()]
+    for record in sorted(records, key=lambda r: r[1]):
+        to_reapply[str(record[0])] = list(record[1:])
+    settings["to_reapply"] = to_reapply
+    return settings
+
+
+class StickyStore:
+    """SQLite database of the sticky roles, shared by every shard
+
+    It runs in WAL mode, and each change only touches the rows of its
+    server, so shards never overwrite each other's servers. A shard
+    only loads the servers it owns"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        """Sets db only once the database is usable"""
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                             check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS servers "
+                       "(server_id TEXT PRIMARY KEY, sticky_roles TEXT, "
+                       "retention INTEGER, max_records INTEGER)")
+            db.execute("CREATE TABLE IF NOT EXISTS records "
+                       "(server_id TEXT, member_id TEXT, left_at INTEGER, "
+                       "roles TEXT, PRIMARY KEY (server_id, member_id))")
+        except:
+            db.close()
+            raise
+        self.db = db
+
+    def migrate(self, path):
+        """Moves the settings of the old JSON file into the database"""
+        try:
+            os.remove(SNAPSHOT_PATH) # The JSON file's, not needed anymore
+        except OSError:
+            pass
+        if not os.path.exists(path):
+            return
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            data = dataIO.load_json(path)
+            for server_id, settings in data.items():
+                settings = import_settings(settings)
+                self.save_settings(server_id, settings)
+                for member_id, record in settings["to_reapply"].items():
+                    self.save_record(server_id, member_id, record)
+            # Emptied within the transaction so other shards can't
+            # import it again
+            if data:
+                dataIO.save_json(path, {})
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def load(self, shard_id, shard_count):
+        """Returns the settings of the servers owned by the shard
+
+        A server belongs to shard (server_id >> 22) % shard_count, like
+        Discord assigns them. Records are loaded oldest first"""
+        if shard_count:
+            where = " WHERE (CAST(server_id AS INTEGER) >> 22) % ? = ?"
+            args = (shard_count, shard_id or 0)
+        else:
+            where = ""
+            args = ()
+        db = {}
+        for server_id, roles, retention, max_records in self.db.execute(
+                "SELECT server_id, sticky_roles, retention, max_records "
+                "FROM servers" + where, args):
+            settings = db[server_id] = default_settings()
+            settings["sticky_roles"] = json.loads(roles)
+            settings["retention"] = retention
+            settings["max_records"] = max_records
+        for server_id, member_id, left_at, roles in self.db.execute(
+                "SELECT server_id, member_id, left_at, roles FROM records" +
+                where + " ORDER BY left_at", args):
+            if server_id not in db:
+                db[server_id] = default_settings()
+            db[server_id]["to_reapply"][member_id] = \
+                [left_at] + json.loads(roles)
+        return db
+
+    def save_settings(self, server_id, settings):
+        self.db.execute("INSERT OR REPLACE INTO servers (server_id, "
+                        "sticky_roles, retention, max_records) "
+                        "VALUES (?, ?, ?, ?)",
+                        (server_id, json.dumps(settings["sticky_roles"]),
+                         settings["retention"], settings["max_records"]))
+
+    def save_record(self, server_id, member_id, record):
+        self.db.execute("INSERT OR REPLACE INTO records (server_id, "
+                        "member_id, left_at, roles) VALUES (?, ?, ?, ?)",
+                        (server_id, member_id, record[0],
+                         json.dumps(record[1:])))
+
+    def delete_records(self, server_id, member_ids):
+        self.db.executemany("DELETE FROM records WHERE server_id = ? AND "
+                            "member_id = ?",
+                            ((server_id, m) for m in member_ids))
+
+    def delete_server(self, server_id):
+        self.db.execute("DELETE FROM servers WHERE server_id = ?",
+                        (server_id,))
+        self.db.execute("DELETE FROM records WHERE server_id = ?",
+                        (server_id,))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
 
 class StickyRoles:
@@ -16,13 +166,28 @@ class StickyRoles:
 
     def __init__(self, bot):
         self.bot = bot
-        db = dataIO.load_json("data/stickyroles/stickyroles.json")
-        self.db = defaultdict(lambda: default.copy(), db)
+        self.db = defaultdict(default_settings)
+        self.store = StickyStore(DB_PATH)
+        # A single thread, so that the connection is never used concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.ready = asyncio.Event()
+        self.load_task = bot.loop.create_task(self.load_db())
+        self.compaction_task = bot.loop.create_task(self.compact_records())
+        self.queue = asyncio.Queue()
+        self.queued = set()
+        self.stats = {"reapplied": 0, "retries": 0, "failed": 0}
+        self.workers = [bot.loop.create_task(self.reapply_worker())
+                        for i in range(REAPPLY_WORKERS)]
 
     @commands.group(pass_context=True, aliases=["stickyrole"])
     @checks.admin()
     async def stickyroles(self, ctx):
         """Adds / removes roles to be reapplied on join"""
+        await self.ready.wait()
+        if self.store.db is None:
+            await self.bot.say("The sticky roles' database couldn't be "
+                               "opened.")
+            return
         if ctx.invoked_subcommand is None:
             await self.bot.send_cmd_help(ctx)
 
@@ -36,7 +201,7 @@ class StickyRoles:
                                "consideration.")
             return
         self.db[server.id]["sticky_roles"].append(role.id)
-        self.save()
+        await self.save_settings(server.id)
         await self.bot.say("That role will now be reapplied on join.")
 
     @stickyroles.command(pass_context=True)
@@ -48,18 +213,15 @@ class StickyRoles:
         except ValueError:
             await self.bot.say("That role was never added in the first place.")
         else:
-            self.save()
+            await self.save_settings(server.id)
             await self.bot.say("That role won't be reapplied on join.")
 
     @stickyroles.command(pass_context=True)
     async def clear(self, ctx):
         """Removes all sticky roles"""
         server = ctx.message.server
-        try:
-            del self.db[server.id]
-        except KeyError:
-            pass
-        self.save()
+        self.db.pop(server.id, None)
+        await self.write(self.store.delete_server, server.id)
         await self.bot.say("All sticky roles have been removed.")
 
     @stickyroles.command(name="list", pass_context=True)
@@ -75,61 +237,273 @@ class StickyRoles:
             await self.bot.say("No sticky roles. Add some with `{}stickyroles "
                                "add`".format(ctx.prefix))
 
+    @stickyroles.command(pass_context=True)
+    async def retention(self, ctx, days: int):
+        """Sets for how many days departed members are remembered
+
+        0 will remember them until the record limit is reached"""
+        server = ctx.message.server
+        if days < 0:
+            await self.bot.send_cmd_help(ctx)
+            return
+        settings = self.db[server.id]
+        settings["retention"] = days * 86400
+        await self.save_settings(server.id)
+        if days:
+            await self.bot.say("Departed members will be remembered for "
+                               "{} days.".format(days))
+        else:
+            await self.bot.say("Departed members won't expire anymore.")
+
+    @stickyroles.command(pass_context=True)
+    async def maxrecords(self, ctx, records: int):
+        """Sets how many departed members are remembered
+
+        When the limit is reached the oldest records are dropped"""
+        server = ctx.message.server
+        if not 1 <= records <= MAX_RECORDS_LIMIT:
+            await self.bot.say("The limit must be between 1 and {}."
+                               "".format(MAX_RECORDS_LIMIT))
+            return
+        settings = self.db[server.id]
+        settings["max_records"] = records
+        await self.save_settings(server.id)
+        await self.bot.say("Up to {} departed members will be remembered."
+                           "".format(records))
+
+    @stickyroles.command()
+    async def status(self):
+        """Shows the state of the reapplication queue"""
+        msg = ("Members waiting for their roles: {}\n"
+               "Reapplied: {}\n"
+               "Retried requests: {}\n"
+               "Failed: {}".format(self.queue.qsize(),
+                                   self.stats["reapplied"],
+                                   self.stats["retries"],
+                                   self.stats["failed"]))
+        await self.bot.say(msg)
+
     async def on_member_remove(self, member):
+        await self.ready.wait()
         server = member.server
-        if server.id not in self.db:
+        if self.store.db is None or server.id not in self.db:
             return
 
-        save = False
         settings = self.db[server.id]
+        to_reapply = settings["to_reapply"]
+
+        role_ids = [int(r.id) for r in member.roles
+                    if r.id in settings["sticky_roles"]]
+
+        if not role_ids:
+            return
 
-        for role in member.roles:
-            if role.id in settings["sticky_roles"]:
-                if member.id not in settings["to_reapply"]:
-                    settings["to_reapply"][member.id] = []
-                settings["to_reapply"][member.id].append(role.id)
-                save = True
+        record = to_reapply.pop(member.id, None)
+        if record is not None:
+            role_ids.extend(r for r in record[1:] if r not in role_ids)
 
-        if save:
-            self.save()
+        record = to_reapply[member.id] = [int(time.time())] + role_ids
+        await self.write(self.store.save_record, server.id, member.id, record)
+        await self.purge_records(server.id)
 
     async def on_member_join(self, member):
+        await self.ready.wait()
         server = member.server
-        if server.id not in self.db:
+        if self.store.db is None or server.id not in self.db:
             return
 
-        settings = self.db[server.id]
+        if member.id not in self.db[server.id]["to_reapply"]:
+            return
+
+        key = (server.id, member.id)
+        if key not in self.queued:
+            self.queued.add(key)
+            self.queue.put_nowait(member)
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.gauge("stickyroles_queue", self.queue.qsize())
+
+    async def reapply_worker(self):
+        """Reapplies the roles of queued members
+
+        The roles are reapplied with a few workers so that join waves
+        are dealt with at the rate the API allows, while failed requests
+        are retried with backoff"""
+        try:
+            while True:
+                member = await self.queue.get()
+                try:
+                    await self.reapply_roles(member)
+                finally:
+                    self.queued.discard((member.server.id, member.id))
+                metrics = self.get_metrics()
+                if metrics is not None:
+                    metrics.gauge("stickyroles_queue", self.queue.qsize())
+        except asyncio.CancelledError:
+            pass
+
+    async def reapply_roles(self, member):
+        server = member.server
+        settings = self.db.get(server.id)
+        if settings is None:
+            return
+
+        record = settings["to_reapply"].get(member.id)
+
+        if record is None:
+            return
 
-        if member.id not in settings["to_reapply"]:
+        if self.is_expired(settings, record):
+            del settings["to_reapply"][member.id]
+            await self.write(self.store.delete_records, server.id,
+                             [member.id])
             return
 
         to_add = []
 
-        for role_id in settings["to_reapply"][member.id]:
+        for role_id in record[1:]:
+            role_id = str(role_id)
             if role_id not in settings["sticky_roles"]:
                 continue
             role = discord.utils.get(server.roles, id=role_id)
             if role:
                 to_add.append(role)
 
-        del settings["to_reapply"][member.id]
-
-        if to_add:
+        for attempt in range(MAX_ATTEMPTS):
+            if server.get_member(member.id) is None:
+                return # Left again, the record is kept for the next join
             try:
-                await self.bot.add_roles(member, *to_add)
+                if to_add:
+                    await self.bot.add_roles(member, *to_add)
             except discord.Forbidden:
                 print("Failed to add roles to {} ({})\n{}\n"
                       "I lack permissions to do that."
                       "".format(member, member.id, to_add))
+                break
+            except discord.NotFound:
+                return
             except discord.HTTPException as e:
                 print("Failed to add roles to {} ({})\n{}\n"
                       "{}"
                       "".format(member, member.id, to_add, e))
+                self.stats["retries"] += 1
+                await asyncio.sleep(2 ** (attempt + 1))
+            else:
+                # The member might have left and rejoined in the meantime
+                if settings["to_reapply"].get(member.id) is record:
+                    del settings["to_reapply"][member.id]
+                    await self.write(self.store.delete_records, server.id,
+                                     [member.id])
+                self.stats["reapplied"] += 1
+                return
+
+        self.stats["failed"] += 1
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.inc("stickyroles_failed_total")
+
+    def is_expired(self, settings, record, now=None):
+        if not settings["retention"]:
+            return False
+        now = now or time.time()
+        return record[0] + settings["retention"] < now
 
-        self.save()
+    async def purge_records(self, server_id):
+        """Drops expired records and the oldest ones beyond the limit
 
-    def save(self):
-        dataIO.save_json("data/stickyroles/stickyroles.json", self.db)
+        Records are kept in departure order, so only the head of the
+        OrderedDict has to be looked at. Returns the number of
+        dropped records"""
+        settings = self.db[server_id]
+        to_reapply = settings["to_reapply"]
+        now = time.time()
+        dropped = []
+        while to_reapply:
+            member_id, oldest = next(iter(to_reapply.items()))
+            if (len(to_reapply) > settings["max_records"] or
+                    self.is_expired(settings, oldest, now)):
+                to_reapply.popitem(last=False)
+                dropped.append(member_id)
+            else:
+                break
+        if dropped:
+            await self.write(self.store.delete_records, server_id, dropped)
+        return len(dropped)
+
+    async def compact_records(self):
+        """Periodically drops expired records"""
+        try:
+            await self.ready.wait()
+            if self.store.db is None:
+                return
+            while True:
+                for server_id in list(self.db):
+                    try:
+                        await self.purge_records(server_id)
+                    except Exception as e:
+                        print("StickyRoles: couldn't drop the expired "
+                              "records: {}".format(e))
+                await asyncio.sleep(COMPACTION_INTERVAL)
+        except asyncio.CancelledError:
+            pass
+
+    async def load_db(self):
+        """Opens the database, commands wait for this to be done
+
+        If it can't be opened they say so instead. A failed import of
+        stickyroles.json is rolled back and tried again on the next load"""
+        try:
+            await self.run(self.store.open)
+        except Exception as e:
+            print("StickyRoles: couldn't open the sticky roles' database: "
+                  "{}".format(e))
+            return
+        try:
+            try:
+                await self.run(self.store.migrate, JSON_PATH)
+            except Exception as e:
+                print("StickyRoles: couldn't import stickyroles.json: "
+                      "{}".format(e))
+            bot = self.bot
+            db = await self.run(self.store.load, getattr(bot, "shard_id", None),
+                                getattr(bot, "shard_count", None))
+            self.db.update(db)
+        except Exception as e:
+            print("StickyRoles: couldn't load the sticky roles: {}".format(e))
+            self.store.db = None
+        finally:
+            self.ready.set()
+
+    def run(self, func, *args):
+        return self.bot.loop.run_in_executor(self.executor, func, *args)
+
+    async def write(self, func, *args):
+        start = time.perf_counter()
+        await self.run(func, *args)
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.observe("db_write_seconds", time.perf_counter() - start,
+                            cog="stickyroles")
+
+    async def save_settings(self, server_id):
+        """Saves the server's settings and drops the records they exclude"""
+        await self.write(self.store.save_settings, server_id,
+                         self.db[server_id])
+        await self.purge_records(server_id)
+
+    def get_metrics(self):
+        metrics = self.bot.get_cog("Metrics")
+        if metrics is not None and metrics.enabled:
+            return metrics
+        return None
+
+    def __unload(self):
+        self.load_task.cancel()
+        self.compaction_task.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        self.executor.submit(self.store.close)
+        self.executor.shutdown(wait=False)
 
 
 def check_folders():
@@ -138,13 +512,6 @@ def check_folders():
         os.makedirs("data/stickyroles")
 
 
-def check_files():
-    if not dataIO.is_valid_json("data/stickyroles/stickyroles.json"):
-        print("Creating empty stickyroles.json...")
-        dataIO.save_json("data/stickyroles/stickyroles.json", {})
-
-
 def setup(bot):
     check_folders()
-    check_files()
-    bot.add_cog(StickyRoles(bot))
\ No newline at end of file
+    bot.add_cog(StickyRoles(bot))
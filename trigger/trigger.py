@@ -3,14 +3,56 @@ import datetime
 import os
 import asyncio
 import re
+import io
+import json
+import copy
+import hashlib
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from discord.ext import commands
 from cogs.utils import checks
 from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import box, pagify, escape_mass_mentions
-from random import choice
+from random import choice, randrange
+from collections import OrderedDict, defaultdict
 
 __author__ = "Twentysix"
 
+TRIGGERS_PATH = "data/trigger/triggers.json"
+SNAPSHOT_PATH = "data/trigger/triggers.snapshot"
+SNAPSHOT_VERSION = 2
+LOCK_PATH = "data/trigger/triggers.lock" # Held by the shard saving
+WATCH_INTERVAL = 5 # Seconds between checks of triggers.json for outside edits
+FILES_PATH = os.path.join("data", "trigger", "files")
+FILES_CHECK_INTERVAL = 30 # Seconds between checks of the files folder
+FILES_TTL = 600 # Seconds after which file responses are resolved again
+FILE_CACHE_SIZE = 64 * 1024 * 1024 # Bytes
+FILE_CACHE_MAX_ENTRY = 8 * 1024 * 1024 # Bigger files are read on each send
+RESPONSES_DB = os.path.join("data", "trigger", "responses.db")
+HOT_RESPONSES = 32 # Responses cached in memory per disk trigger
+STATS_PATH = "data/trigger/stats.json"
+SHARD_STATS_PATH = "data/trigger/stats-{}.json"
+COUNTS_INTERVAL = 60 # Seconds between syncs of the shared fire counts
+STATS_INTERVAL = 600 # Seconds between saves of the hit stats
+# Period name -> (bucket width in seconds, number of buckets)
+STATS_PERIODS = OrderedDict((("hour", (60, 60)),
+                             ("day", (3600, 24)),
+                             ("month", (86400, 30))))
+MAX_STATS_CHANNELS = 10
+SETTINGS_PATH = "data/trigger/settings.json"
+# Responses, seconds
+DEFAULT_SERVER_RATE = (20, 10)
+DEFAULT_CHANNEL_RATE = (10, 10)
+MAX_RATE = 5 # Responses per second a server can allow at most
+BUCKETS_PRUNE_INTERVAL = 300 # Seconds between evictions of idle buckets
+MEMBER_NAMES_SIZE = 1024
+NO_MEMBER = object() # Cached for users found in no server
+TEST_RUNS = 5 # Times each trigger is checked by trigger test
+
 
 class TriggerError(Exception):
     pass
@@ -34,12 +76,36 @@ class Trigger:
     def __init__(self, bot):
         self.bot = bot
         self.triggers = []
-        self.load_triggers()
+        self.names = {} # Lowercase name -> trigger
+        self.triggers_stat = None # triggers.json's as of the last read / write
+        self.saved = {} # Lowercase name -> trigger as last read / written
+        self.load_failed = False # If so triggers.json isn't overwritten
+        self.save_pending = False
+        self.save_failed = False # Retried by save_stats
+        self.save_lock = asyncio.Lock()
+        self.files_checked = self.files_resolved = time.monotonic()
+        self.files_mtime = None
+        self.file_cache = FileCache(FILE_CACHE_SIZE, FILE_CACHE_MAX_ENTRY)
+        self.prefixes = {}
+        self.store = ResponseStore(RESPONSES_DB, bot.loop)
+        self.hit_stats = HitStats({})
+        self.stats_path = stats_path(bot)
+        self.counts = defaultdict(int) # Lowercase name -> unsynced fires
+        self.settings = dataIO.load_json(SETTINGS_PATH)
+        self.buckets = {}
+        self.buckets_pruned = time.monotonic()
+        self.dropped = defaultdict(int)
+        self.member_names = OrderedDict() # User id -> name, LRU
+        self.admin_roles = {} # Server id -> (admin role name, role ids)
+        self.ready = asyncio.Event()
+        self.load_task = bot.loop.create_task(self.load_triggers())
         self.stats_task = bot.loop.create_task(self.save_stats())
+        self.watch_task = bot.loop.create_task(self.watch_triggers())
 
     @commands.group(pass_context=True, no_pm=True)
     async def trigger(self, ctx):
         """Trigger creation commands"""
+        await self.ready.wait()
         if ctx.invoked_subcommand is None:
             await self.bot.send_cmd_help(ctx)
 
@@ -88,12 +154,13 @@ class Trigger:
         if trigger is None:
             await self.bot.say("That trigger doesn't exist.")
             return
-        if not trigger.can_edit(author):
+        if not trigger.can_edit(author, self.is_admin(author)):
             await self.bot.say("You're not allowed to edit that trigger.")
             return
 
         if response is not None:
-            trigger.responses.append(response)
+            await trigger.add_response(response)
+            trigger.edited()
             await self.bot.say("Response added.")
         else: # Interactive mode
             await self.interactive_add_mode(trigger, ctx)
@@ -109,10 +176,10 @@ class Trigger:
         if trigger is None:
             await self.bot.say("That trigger doesn't exist.")
             return
-        if trigger.responses == []:
+        if not trigger.responses:
             await self.bot.say("That trigger has no responses to delete.")
             return
-        if not trigger.can_edit(author):
+        if not trigger.can_edit(author, self.is_admin(author)):
             await self.bot.say("You're not allowed to do that.")
             return
 
@@ -121,8 +188,8 @@ class Trigger:
         past_messages = []
         quit_msg = "\nType 'exit' to quit removal mode."
 
-        while self.get_n_trigger_responses(trigger) is not None:
-            r_list = self.get_n_trigger_responses(trigger, truncate=100)
+        while trigger.responses:
+            r_list = await self.get_n_trigger_responses(trigger, truncate=100)
             if current_list is None:
                 current_list = await self.bot.say(r_list + quit_msg)
             else:
@@ -138,7 +205,8 @@ class Trigger:
                 break
             try:
                 i = int(msg.content)
-                del trigger.responses[i]
+                await trigger.delete_response(i)
+                trigger.edited()
             except:
                 pass
             past_messages.append(msg)
@@ -146,6 +214,7 @@ class Trigger:
         if not trigger.responses:
             await self.bot.say("No more responses to delete.")
 
+        self.save_triggers()
         past_messages.append(current_list)
         await self.attempt_cleanup(past_messages)
 
@@ -164,7 +233,7 @@ class Trigger:
         trigger = self.get_trigger_by_name(trigger_name)
         if trigger:
             msg = "Name: {}\n".format(trigger.name)
-            owner_name = discord.utils.get(self.bot.get_all_members(), id=trigger.owner)
+            owner_name = self.get_member_name(trigger.owner, ctx.message.server)
             owner_name = owner_name if owner_name is not None else "not found"
             msg += "Owner: {} ({})\n".format(owner_name, trigger.owner)
             trigger_type = "all responses" if trigger.type == "all" else "random response"
@@ -188,7 +257,13 @@ class Trigger:
         """Shows all responses of a trigger"""
         trigger = self.get_trigger_by_name(trigger_name)
         if trigger:
-            payload = self.elaborate_payload(trigger.responses, truncate=9999)
+            payload = trigger.cache.get("show")
+            if payload is None:
+                payload = self.elaborate_payload(await trigger.get_responses(),
+                                                 truncate=9999)
+                # Disk responses aren't kept in memory, even rendered
+                if trigger.storage != "disk":
+                    trigger.cache["show"] = payload
             if payload:
                 payload = "\n\n".join(payload)
                 if len(payload) > 2000:
@@ -229,17 +304,206 @@ class Trigger:
     @trigger.command(pass_context=True)
     async def search(self, ctx, *, search_terms : str):
         """Returns triggers matching the search terms"""
-        result = self.search_triggers(search_terms.lower())
+        search_terms = search_terms.lower()
+        on_disk = await self.store.search(search_terms)
+        result = self.search_triggers(search_terms, on_disk)
         if result:
             result = ", ".join(sorted([t.name for t in result]))
             await self.bot.say("Triggers found:\n\n{}".format(result))
         else:
             await self.bot.say("No triggers matching your search.")
 
+    @trigger.group(name="stats", pass_context=True)
+    async def _stats(self, ctx):
+        """Shows how often triggers are fired"""
+        if ctx.invoked_subcommand is None:
+            await self.bot.send_cmd_help(ctx)
+
+    @_stats.command(name="top", pass_context=True)
+    async def stats_top(self, ctx, period : str="day"):
+        """Shows this server's most fired triggers
+
+        Global triggers are listed apart: their hits are counted across
+        all servers. Available periods: hour, day, month"""
+        server = ctx.message.server
+        period = period.lower()
+        if period not in STATS_PERIODS:
+            await self.bot.say("Invalid period.")
+            return
+        local = [t for t in self.triggers if t.server == server.id]
+        top = self.hit_stats.top(local, period)
+        top_global = self.hit_stats.top([t for t in self.triggers
+                                         if t.server is None], period)
+        if not top and not top_global:
+            await self.bot.say("No trigger has been fired in the last "
+                               "{}.".format(period))
+            return
+        server_hits = self.hit_stats.server_hits(server.id, period)
+        msg = "Fired in this server in the last {}: {}\n\n".format(period,
+                                                                 server_hits)
+        for trigger, hits in top:
+            msg += "{}: {}\n".format(trigger.name, hits)
+        if top_global:
+            msg += "\nGlobal triggers, hits in all servers:\n"
+            for trigger, hits in top_global:
+                msg += "{}: {}\n".format(trigger.name, hits)
+        await self.bot.say(box(msg, lang="xl"))
+
+    @_stats.command(name="show", pass_context=True)
+    async def stats_show(self, ctx, trigger_name : str):
+        """Shows how often a trigger has been fired and where"""
+        server = ctx.message.server
+        trigger = self.get_trigger_by_name(trigger_name)
+        if trigger is None:
+            await self.bot.say("That trigger doesn't exist.")
+            return
+        msg = "Name: {}\n".format(trigger.name)
+        for period in STATS_PERIODS:
+            msg += "Last {}: {}\n".format(period,
+                                          self.hit_stats.hits(trigger, period))
+        msg += "Total: {}\n".format(trigger.triggered)
+        channels = self.hit_stats.channels(trigger)
+        channels = [(server.get_channel(c), n) for c, n in channels]
+        channels = ["#{}: {}".format(c.name, n) for c, n in channels
+                    if c is not None]
+        if channels:
+            msg += "Channels:\n    " + "\n    ".join(channels)
+        await self.bot.say(box(msg, lang="xl"))
+
+    @_stats.command(name="dead", pass_context=True)
+    async def stats_dead(self, ctx):
+        """Lists this server's triggers that weren't fired in a month"""
+        server = ctx.message.server
+        dead = [t.name for t in self.triggers if t.server == server.id and
+                not self.hit_stats.hits(t, "month")]
+        if dead:
+            for page in pagify(", ".join(sorted(dead)), delims=[" "]):
+                await self.bot.say("```\n{}\n```".format(page.lstrip(" ")))
+        else:
+            await self.bot.say("Every trigger has been fired this month.")
+
+    @trigger.command(pass_context=True)
+    @checks.admin_or_permissions(administrator=True)
+    async def test(self, ctx, *, text : str):
+        """Shows which triggers the text would fire and what they cost
+
+        Nothing is sent, and cooldowns and counters are left alone.
+        Also shows the slowest triggers to check and the fired ones
+        whose phrases overlap"""
+        message = copy.copy(ctx.message)
+        message.content = text
+        lowered = text.lower()
+        server = message.server
+        triggers = [t for t in self.triggers
+                    if t.server == server.id or t.server is None]
+        matched = []
+        timings = []
+        for trigger in triggers:
+            best = None
+            for i in range(TEST_RUNS):
+                start = time.perf_counter()
+                match = trigger.matches(message, lowered)
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings.append((best, trigger))
+            if match:
+                matched.append(trigger)
+        total = sum(t for t, trigger in timings)
+        msg = ("{} triggers checked in {:.3f}ms\n\n"
+               "".format(len(triggers), total * 1000))
+        if matched:
+            msg += "Fired:\n"
+            for trigger in matched:
+                msg += "    {}{}\n".format(trigger.name,
+                                           " (on cooldown)"
+                                           if trigger.on_cooldown() else "")
+        else:
+            msg += "No trigger would be fired.\n"
+        timings.sort(key=lambda t: t[0], reverse=True)
+        msg += "\nSlowest:\n"
+        for elapsed, trigger in timings[:5]:
+            msg += "    {} {:.3f}ms{}\n".format(trigger.name, elapsed * 1000,
+                                                " (regex)" if trigger.regex
+                                                else "")
+        overlaps = ["    {} is fired whenever {} is\n".format(b.name, a.name)
+                    for a in matched for b in matched
+                    if a is not b and b.fired_with(a)]
+        if overlaps:
+            msg += "\nOverlapping:\n" + "".join(overlaps)
+        for page in pagify(msg, delims=["\n"], shorten_by=16):
+            await self.bot.say(box(page))
+
+    @trigger.command(name="export")
+    @checks.is_owner()
+    async def _export(self, filename : str="triggers.jsonl"):
+        """Exports all triggers to data/trigger
+
+        One trigger per line, as JSON"""
+        path = os.path.join("data", "trigger", os.path.basename(filename))
+        triggers = []
+        for trigger in self.triggers:
+            data = trigger.export()
+            if trigger.storage == "disk":
+                data["responses"] = await trigger.get_responses()
+                del data["storage"]
+            triggers.append(data)
+        await self.bot.loop.run_in_executor(None, write_jsonl, path, triggers)
+        await self.bot.say("{} triggers exported to `{}`."
+                           "".format(len(triggers), path))
+
+    @trigger.command(name="import", pass_context=True)
+    @checks.is_owner()
+    async def _import(self, ctx, filename : str="triggers.jsonl"):
+        """Imports triggers from a file in data/trigger
+
+        The file must have one trigger per line, as JSON, like the
+        ones made by trigger export. Triggers whose name is already
+        taken are skipped."""
+        path = os.path.join("data", "trigger", os.path.basename(filename))
+        if not os.path.isfile(path):
+            await self.bot.say("There is no `{}` file.".format(path))
+            return
+        author = ctx.message.author
+        names = set(self.names)
+        triggers, errors, duplicates = await self.bot.loop.run_in_executor(
+            None, read_jsonl, path, names, author.id)
+        for trigger in triggers:
+            trigger.bot = self.bot
+            trigger.store = self.store
+        self.triggers.extend(triggers)
+        self.rebuild_index()
+        self.save_triggers()
+        msg = "Imported {} triggers.".format(len(triggers))
+        if duplicates:
+            msg += "\n{} skipped, their name is already taken.".format(duplicates)
+        if errors:
+            msg += "\n{} invalid lines:\n".format(len(errors))
+            msg += "\n".join(errors[:10])
+            if len(errors) > 10:
+                msg += "\n..."
+        await self.bot.say(msg)
+
+    @trigger.command()
+    @checks.is_owner()
+    async def filecache(self):
+        """Shows the stats of the file responses' cache"""
+        cache = self.file_cache
+        lookups = cache.hits + cache.misses
+        ratio = cache.hits / lookups * 100 if lookups else 0
+        msg = "Files: {}\n".format(len(cache.entries))
+        msg += "Size: {:.1f} / {:.1f} MB\n".format(cache.size / 1048576,
+                                                  cache.max_size / 1048576)
+        msg += "Hits: {} ({:.1f}%)\n".format(cache.hits, ratio)
+        msg += "Misses: {}\n".format(cache.misses)
+        msg += "Evictions: {}\n".format(cache.evictions)
+        await self.bot.say(box(msg, lang="xl"))
+
     @commands.group(pass_context=True, no_pm=True)
     @checks.admin_or_permissions(administrator=True)
     async def triggerset(self, ctx):
         """Edits the settings of a trigger"""
+        await self.ready.wait()
         if ctx.invoked_subcommand is None:
             await self.bot.send_cmd_help(ctx)
 
@@ -362,6 +626,49 @@ class Trigger:
         self.save_triggers()
         await self.bot.say("Regex set to {}.".format(true_or_false))
 
+    @triggerset.command(pass_context=True)
+    async def ratelimit(self, ctx, scope : str=None, responses : int=None,
+                        seconds : int=None):
+        """Limits how many responses triggers can send
+
+        A trigger firing counts as one response, however many
+        responses its payload has.
+        Available scopes: server, channel
+        Example: ratelimit channel 5 10
+        At most 5 responses every 10 seconds in each channel
+
+        Shows the current limits if no scope is given"""
+        server = ctx.message.server
+        settings = self.settings.get(server.id, {})
+        if scope is None:
+            msg = "Server: {} responses every {} seconds\n".format(
+                *settings.get("server_rate", DEFAULT_SERVER_RATE))
+            msg += "Channel: {} responses every {} seconds\n".format(
+                *settings.get("channel_rate", DEFAULT_CHANNEL_RATE))
+            msg += "Dropped: {} responses\n".format(self.dropped[server.id])
+            await self.bot.say(box(msg, lang="xl"))
+            return
+        scope = scope.lower()
+        if scope not in ("server", "channel") or responses is None \
+                or seconds is None:
+            await self.bot.send_cmd_help(ctx)
+            return
+        if responses < 1 or seconds < 1:
+            await self.bot.say("Both values must be at least 1.")
+            return
+        if responses / seconds > MAX_RATE:
+            await self.bot.say("That's too many. At most {} responses per "
+                               "second are allowed.".format(MAX_RATE))
+            return
+        settings[scope + "_rate"] = [responses, seconds]
+        self.settings[server.id] = settings
+        await self.bot.loop.run_in_executor(None, dataIO.save_json,
+                                            SETTINGS_PATH,
+                                            copy.deepcopy(self.settings))
+        await self.bot.say("Triggers will send at most {} responses every {} "
+                           "seconds in each {}.".format(responses, seconds,
+                                                        scope))
+
     @triggerset.command(pass_context=True)
     async def active(self, ctx, trigger_name : str, true_or_false : bool):
         """Toggles the trigger on/off.
@@ -375,11 +682,41 @@ class Trigger:
         self.save_triggers()
         await self.bot.say("Trigger active: {}.".format(true_or_false))
 
+    @triggerset.command(pass_context=True)
+    async def storage(self, ctx, trigger_name : str, mode : str):
+        """Sets where the trigger's responses are kept
+
+        Available modes: memory, disk
+
+        Memory keeps them loaded at all times
+        Disk reads them from a database when needed, which saves memory
+        on random triggers with many responses"""
+        author = ctx.message.author
+        trigger = self.get_trigger_by_name(trigger_name)
+        if not await self.settings_check(trigger, author):
+            return
+        mode = mode.lower()
+        if mode not in ("memory", "disk"):
+            await self.bot.say("Invalid mode.")
+            return
+        if mode != trigger.storage:
+            responses = await trigger.get_responses()
+            if mode == "disk":
+                await self.store.replace(trigger.name, responses)
+                trigger.responses = DiskResponses(self.store, trigger.name)
+            else:
+                trigger.responses = responses
+                await self.store.drop(trigger.name)
+            trigger.storage = mode
+            trigger.edited()
+            self.save_triggers()
+        await self.bot.say("Storage set to {}.".format(mode))
+
     async def settings_check(self, trigger, author):
         if not trigger:
             await self.bot.say("That trigger doesn't exist.")
             return False
-        elif not trigger.can_edit(author):
+        elif not trigger.can_edit(author, self.is_admin(author)):
             await self.bot.say("You're not authorized to edit that triggers' "
                                "settings.")
             return False
@@ -387,24 +724,28 @@ class Trigger:
             return True
 
     def get_trigger_by_name(self, name):
+        return self.names.get(name.lower())
+
+    def rebuild_index(self):
+        self.names = {}
         for trigger in self.triggers:
-            if trigger.name.lower() == name.lower():
-                return trigger
-        return None
+            self.names.setdefault(trigger.name.lower(), trigger)
 
-    def search_triggers(self, search_terms):
+    def search_triggers(self, search_terms, on_disk):
+        """on_disk are the names of the disk triggers with a response
+        matching the search terms"""
         results = []
         for trigger in self.triggers:
             if search_terms in trigger.name.lower():
                 results.append(trigger)
                 continue
-            for payload in trigger.responses:
-                if search_terms in payload.lower():
-                    results.append(trigger)
-                    break
+            if trigger.storage == "disk":
+                found = trigger.name in on_disk
             else:
-                if search_terms in trigger.triggered_by.lower():
-                    results.append(trigger)
+                found = any(search_terms in payload.lower()
+                            for payload in trigger.responses)
+            if found or search_terms in trigger.triggered_by.lower():
+                results.append(trigger)
         return results
 
     def create_trigger(self, name, triggered_by, ctx):
@@ -412,21 +753,30 @@ class Trigger:
         if not trigger:
             author = ctx.message.author
             trigger = TriggerObj(bot=self.bot,
+                                 store=self.store,
                                  name=name,
                                  triggered_by=triggered_by,
                                  owner=author.id,
                                  server=author.server.id
                                 )
             self.triggers.append(trigger)
+            self.names[name.lower()] = trigger
         else:
             raise AlreadyExists()
 
     def delete_trigger(self, name, ctx):
         trigger = self.get_trigger_by_name(name)
         if trigger:
-            if not trigger.can_edit(ctx.message.author):
+            author = ctx.message.author
+            if not trigger.can_edit(author, self.is_admin(author)):
                 raise Unauthorized()
             self.triggers.remove(trigger)
+            if trigger.storage == "disk":
+                self.store.drop(trigger.name)
+            self.store.forget_count(trigger.name.lower())
+            self.counts.pop(trigger.name.lower(), None)
+            self.hit_stats.forget(trigger)
+            self.rebuild_index()
             self.save_triggers()
         else:
             raise NotFound()
@@ -460,11 +810,21 @@ class Trigger:
             if msg.content.lower().strip() == "exit":
                 await self.bot.say("Your changes have been saved.")
                 break
-            trigger.responses.append(msg.content)
-
-    def get_n_trigger_responses(self, trigger, *, truncate=2000):
+            await trigger.add_response(msg.content)
+            trigger.edited()
+
+    async def get_n_trigger_responses(self, trigger, *, truncate=2000):
+        if trigger.storage == "disk": # Not cached, to keep them off memory
+            return self.render_responses(await trigger.get_responses(),
+                                         truncate)
+        key = ("list", truncate)
+        if key not in trigger.cache:
+            trigger.cache[key] = self.render_responses(trigger.responses,
+                                                       truncate)
+        return trigger.cache[key]
+
+    def render_responses(self, responses, truncate):
         msg = ""
-        responses = trigger.responses
         i = 0
         for r in responses:
             if len(r) > truncate:
@@ -482,10 +842,16 @@ class Trigger:
             prefixes = self.bot.command_prefix(self.bot, msg)
         else:
             prefixes = self.bot.command_prefix
-        for p in prefixes:
-            if msg.content.startswith(p):
-                return True
-        return False
+        # The prefixes are replaced, not edited, when they're changed, so
+        # the tuple only has to be rebuilt when we get a different object
+        cached = self.prefixes.get(msg.server.id)
+        if cached is None or cached[0] is not prefixes:
+            if isinstance(prefixes, str):
+                as_tuple = (prefixes,)
+            else:
+                as_tuple = tuple(prefixes)
+            cached = self.prefixes[msg.server.id] = (prefixes, as_tuple)
+        return msg.content.startswith(cached[1])
 
     def elaborate_response(self, trigger, r):
         settings = self.bot.settings
@@ -495,65 +861,1137 @@ class Trigger:
             return "text", r
         if not r.startswith("file:"):
             return "text", r
-        else:
-            path = r.replace("file:", "").strip()
-        path = os.path.join("data", "trigger", "files", path)
-        if os.path.isfile(path):
+        self.check_files()
+        resolved = trigger.files.get(r)
+        if resolved is None:
+            resolved = trigger.files[r] = self.resolve_file(r)
+        return resolved
+
+    def resolve_file(self, r):
+        path = r.replace("file:", "").strip()
+        path = os.path.join(FILES_PATH, path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return "text", r
+        if not stat.S_ISREG(st.st_mode):
+            return "text", r
+        if st.st_size > self.file_cache.max_entry:
             return "file", path
+        return "cached", (path, st.st_mtime)
+
+    def get_member_name(self, user_id, server):
+        """Finds a user's name without going through every member
+
+        Names found in other servers, and users found in none, are kept
+        in an LRU cache that is updated by the member events"""
+        member = server.get_member(user_id)
+        if member is not None:
+            return str(member)
+        name = self.member_names.get(user_id)
+        if name is not None:
+            self.member_names.move_to_end(user_id)
+            return None if name is NO_MEMBER else name
+        name = NO_MEMBER
+        for s in self.bot.servers:
+            member = s.get_member(user_id)
+            if member is not None:
+                name = str(member)
+                break
+        self.member_names[user_id] = name
+        if len(self.member_names) > MEMBER_NAMES_SIZE:
+            self.member_names.popitem(last=False)
+        return None if name is NO_MEMBER else name
+
+    def is_admin(self, user):
+        server = user.server
+        admin_role = self.bot.settings.get_server_admin(server)
+        cached = self.admin_roles.get(server.id)
+        if cached is None or cached[0] != admin_role:
+            role_ids = frozenset(r.id for r in server.roles
+                                 if r.name == admin_role)
+            cached = self.admin_roles[server.id] = (admin_role, role_ids)
+        role_ids = cached[1]
+        return any(r.id in role_ids for r in user.roles)
+
+    async def on_member_join(self, member):
+        if self.member_names.get(member.id) is NO_MEMBER:
+            self.member_names[member.id] = str(member)
+
+    async def on_member_update(self, before, after):
+        if after.id in self.member_names:
+            self.member_names[after.id] = str(after)
+
+    async def on_server_role_create(self, role):
+        self.admin_roles.pop(role.server.id, None)
+
+    async def on_server_role_delete(self, role):
+        self.admin_roles.pop(role.server.id, None)
+
+    async def on_server_role_update(self, before, after):
+        self.admin_roles.pop(after.server.id, None)
+
+    def take_token(self, message):
+        """Takes a token from the server's and the channel's buckets
+
+        Returns False, counting the response as dropped, if either of
+        them is empty"""
+        now = time.monotonic()
+        if now - self.buckets_pruned > BUCKETS_PRUNE_INTERVAL:
+            self.prune_buckets(now)
+        server = message.server
+        settings = self.settings.get(server.id, {})
+        # Default channels share their id with the server
+        server_bucket = self.get_bucket(("server", server.id), settings.get(
+            "server_rate", DEFAULT_SERVER_RATE), now)
+        channel_bucket = self.get_bucket(("channel", message.channel.id),
+                                         settings.get("channel_rate",
+                                                      DEFAULT_CHANNEL_RATE),
+                                         now)
+        if server_bucket.tokens >= 1 and channel_bucket.tokens >= 1:
+            server_bucket.tokens -= 1
+            channel_bucket.tokens -= 1
+            return True
+        self.dropped[server.id] += 1
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.inc("trigger_dropped_total")
+        return False
+
+    def prune_buckets(self, now):
+        """Forgets the buckets that have refilled, a new one is the same"""
+        self.buckets_pruned = now
+        for key, bucket in list(self.buckets.items()):
+            if bucket.full(now):
+                del self.buckets[key]
+
+    def get_bucket(self, key, rate, now):
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.rate != tuple(rate):
+            bucket = self.buckets[key] = TokenBucket(rate, now)
         else:
-            return "text", r
+            bucket.refill(now)
+        return bucket
 
-    async def on_message(self, message):
-        channel = message.channel
-        author = message.author
+    def check_files(self):
+        """Forgets resolved file responses if they might be outdated
 
-        if message.server is None:
+        That happens when the content of the files folder changes, which
+        is checked every FILES_CHECK_INTERVAL seconds, or every FILES_TTL
+        seconds to catch files that were edited in place"""
+        now = time.monotonic()
+        if now - self.files_checked < FILES_CHECK_INTERVAL:
             return
+        self.files_checked = now
+        try:
+            mtime = os.stat(FILES_PATH).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.files_mtime or now - self.files_resolved > FILES_TTL:
+            self.files_mtime = mtime
+            self.files_resolved = now
+            for trigger in self.triggers:
+                trigger.files.clear()
 
-        if author == self.bot.user:
+    async def on_message(self, message):
+        """Own listener, used when the Dispatch cog isn't loaded"""
+        if message.server is None or not self.triggers:
             return
 
-        if not self.bot.user_allowed(message):
+        if message.author == self.bot.user:
             return
 
         if self.is_command(message):
             return
 
-        for trigger in self.triggers:
-            if not trigger.check(message):
+        if not self.bot.user_allowed(message):
+            return
+
+        await self.handle_message(message, message.content.lower())
+
+    def dispatch_check(self, ctx):
+        return (ctx.server_id is not None and bool(self.triggers) and
+                not ctx.is_command and ctx.allowed)
+
+    async def dispatch_message(self, message, ctx):
+        await self.handle_message(message, ctx.lowered)
+
+    async def handle_message(self, message, lowered):
+        channel = message.channel
+        metrics = self.get_metrics()
+        if metrics is not None:
+            start = time.perf_counter()
+
+        triggered = [t for t in self.triggers if t.check(message, lowered)]
+
+        if metrics is not None:
+            matched = time.perf_counter()
+            metrics.observe("trigger_match_seconds", matched - start)
+            metrics.inc("trigger_messages_total")
+            metrics.gauge("trigger_triggers", len(self.triggers))
+
+        now = time.time()
+        for trigger in triggered:
+            if not self.take_token(message):
                 continue
-            payload = trigger.payload()
+            payload = await trigger.payload()
+            if payload:
+                self.hit_stats.hit(trigger, message, now)
+                self.counts[trigger.name.lower()] += 1
             for p in payload:
                 resp_type, resp = self.elaborate_response(trigger, p)
                 if resp_type == "text":
                     await self.bot.send_message(channel, resp)
                 elif resp_type == "file":
                     await self.bot.send_file(channel, resp)
+                elif resp_type == "cached":
+                    path, mtime = resp
+                    try:
+                        data = self.file_cache.get(path, mtime)
+                    except OSError: # Removed since it was resolved
+                        trigger.files.clear()
+                        continue
+                    await self.bot.send_file(channel, io.BytesIO(data),
+                                             filename=os.path.basename(path))
+
+        if metrics is not None and triggered:
+            metrics.observe("trigger_send_seconds",
+                            time.perf_counter() - matched)
+            metrics.inc("trigger_fires_total", len(triggered))
 
     async def save_stats(self):
-        """Saves triggers every 10 minutes to preserve stats"""
+        """Syncs the fire counts every minute and saves the hit stats
+        every 10 minutes
+
+        The counts are shared by the shards in the responses' database,
+        so triggers.json is only written when the triggers are edited"""
         await self.bot.wait_until_ready()
         try:
-            await asyncio.sleep(60)
+            await self.ready.wait()
+            saved = time.monotonic()
             while True:
-                self.save_triggers()
-                await asyncio.sleep(60 * 10)
+                await asyncio.sleep(COUNTS_INTERVAL)
+                if self.save_failed:
+                    self.save_triggers()
+                try:
+                    await self.sync_counts()
+                    if time.monotonic() - saved >= STATS_INTERVAL:
+                        saved = time.monotonic()
+                        await self.write_stats()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("Trigger: couldn't save the stats: {}".format(e))
         except asyncio.CancelledError:
             pass
 
-    def load_triggers(self):
-        triggers = dataIO.load_json("data/trigger/triggers.json")
-        for trigger in triggers:
-            trigger["bot"] = self.bot
-            self.triggers.append(TriggerObj(**trigger))
+    async def sync_counts(self):
+        """Adds this shard's fires to the shared counts and reads them back
+
+        The responses' lengths are read again too, in case another shard
+        has edited them"""
+        counts = dict(self.counts)
+        self.counts.clear()
+        try:
+            totals = await self.store.sync(counts, self.count_seeds(counts))
+        except:
+            for name, n in counts.items(): # Added to the next sync
+                self.counts[name] += n
+            raise
+        for trigger in self.triggers:
+            name = trigger.name.lower()
+            if name in totals:
+                trigger.triggered = totals[name] + self.counts.get(name, 0)
+
+    def count_seeds(self, counts):
+        """Where the fired triggers start from if the store has no count
+        for them yet, without the fires being added"""
+        return {t.name.lower(): t.triggered - counts[t.name.lower()]
+                for t in self.triggers if t.name.lower() in counts}
+
+    async def write_stats(self):
+        stats = self.hit_stats.export()
+        await self.bot.loop.run_in_executor(None, dataIO.save_json,
+                                            self.stats_path, stats)
+
+    async def load_triggers(self):
+        """Loads the triggers in an executor so that the bot isn't held up
+
+        Commands wait for this to be done. If triggers.json can't be
+        read the cog starts without triggers, and doesn't save them
+        until the file is fixed and reloaded by watch_triggers"""
+        loop = self.bot.loop
+        try:
+            try:
+                file_stat, triggers, indexes = await loop.run_in_executor(
+                    None, read_triggers)
+            except Exception as e:
+                print("Trigger: couldn't load triggers.json, it won't be "
+                      "overwritten until it's fixed: {}".format(e))
+                self.load_failed = True
+                file_stat, triggers = stat_triggers(), []
+                indexes = build_indexes([])
+            try:
+                stats = await loop.run_in_executor(None, read_stats,
+                                                   self.stats_path)
+            except Exception as e:
+                print("Trigger: couldn't load the stats: {}".format(e))
+                stats = {}
+            self.triggers_stat = file_stat
+            self.saved = indexes["names"]
+            for trigger, lowered in zip(triggers, indexes["lowered"]):
+                trigger = TriggerObj(bot=self.bot, store=self.store, **trigger)
+                if lowered is not None:
+                    trigger.lowered = (trigger.triggered_by, lowered)
+                self.triggers.append(trigger)
+            try:
+                # The counts of triggers.json are only used for triggers
+                # that have none in the database yet
+                totals = await self.store.load(
+                    {t.name.lower(): t.triggered for t in self.triggers})
+            except Exception as e:
+                print("Trigger: couldn't load the responses' database: "
+                      "{}".format(e))
+            else:
+                for trigger in self.triggers:
+                    trigger.triggered = totals.get(trigger.name.lower(),
+                                                   trigger.triggered)
+            self.hit_stats = HitStats(stats)
+            self.rebuild_index()
+        finally:
+            self.ready.set()
 
     def save_triggers(self):
-        triggers = [t.export() for t in self.triggers]
-        dataIO.save_json("data/trigger/triggers.json", triggers)
+        """Schedules a save of the triggers
+
+        The file is written in an executor to keep the disk I/O off the
+        event loop. Saves requested before the pending one starts are
+        merged into it"""
+        if not self.save_pending:
+            self.save_pending = True
+            self.bot.loop.create_task(self.write_triggers())
+
+    async def write_triggers(self):
+        await self.ready.wait()
+        async with self.save_lock:
+            self.save_pending = False
+            self.save_failed = False
+            start = time.perf_counter()
+            try:
+                if not self.load_failed:
+                    triggers = [t.export() for t in self.triggers]
+                    file_stat, merged, indexes = \
+                        await self.bot.loop.run_in_executor(
+                            None, merge_triggers, triggers, self.saved,
+                            self.triggers_stat)
+                    self.triggers_stat = file_stat
+                    if merged is triggers:
+                        self.saved = indexes["names"]
+                    else: # With other shards' edits
+                        self.apply_triggers(merged, indexes)
+                await self.write_stats()
+            except Exception as e:
+                print("Trigger: couldn't save the triggers, retrying in a "
+                      "minute: {}".format(e))
+                self.save_failed = True
+                return
+            metrics = self.get_metrics()
+            if metrics is not None:
+                metrics.observe("file_write_seconds",
+                                time.perf_counter() - start, cog="trigger")
+
+    async def watch_triggers(self):
+        """Applies the changes made to triggers.json from outside the cog
+
+        The file is only read again when its mtime or size changes. If the
+        cog has unsaved changes of its own, those win"""
+        try:
+            await self.ready.wait()
+            while True:
+                await asyncio.sleep(WATCH_INTERVAL)
+                if (self.save_pending or self.save_failed or
+                        self.save_lock.locked()):
+                    continue
+                if stat_triggers() == self.triggers_stat:
+                    continue
+                try:
+                    file_stat, triggers, indexes = \
+                        await self.bot.loop.run_in_executor(
+                            None, read_edited_triggers)
+                except ValueError: # Caught while being written
+                    continue
+                if (self.save_pending or self.save_failed or
+                        self.save_lock.locked()):
+                    continue
+                self.triggers_stat = file_stat
+                self.apply_triggers(triggers, indexes)
+        except asyncio.CancelledError:
+            pass
+
+    def apply_triggers(self, entries, indexes):
+        """Updates the triggers in memory to match triggers.json's
+
+        Only the added, removed and edited triggers are touched. The
+        others are kept as they are, cooldown and counter included.
+        Entries equal to what was last read or written are unchanged,
+        so those don't even need to be validated"""
+        start = time.perf_counter()
+        seen = set()
+        changes = []
+        for data in entries:
+            try:
+                name = data["name"].lower()
+            except (TypeError, KeyError, AttributeError):
+                name = None # Caught by validate_trigger
+            trigger = self.names.get(name) if name not in seen else None
+            seen.add(name)
+            if trigger is not None and self.saved.get(name) == data:
+                changes.append((trigger, None))
+                continue
+            try:
+                validate_trigger(data)
+            except (ValueError, TypeError) as e:
+                print("Trigger: not reloading triggers.json, {}".format(e))
+                return
+            changes.append((trigger, data))
+        triggers = []
+        added = []
+        edited = 0
+        for trigger, data in changes:
+            if trigger is None:
+                trigger = TriggerObj(bot=self.bot, store=self.store, **data)
+                added.append(trigger)
+            elif data is not None:
+                trigger.reload(data)
+                edited += 1
+            triggers.append(trigger)
+        kept = set(map(id, triggers))
+        removed = [t for t in self.triggers if id(t) not in kept]
+        for trigger in removed:
+            name = trigger.name.lower()
+            if self.names.get(name) is trigger:
+                del self.names[name]
+            if name not in seen:
+                if trigger.storage == "disk":
+                    self.store.drop(trigger.name)
+                self.store.forget_count(name)
+                self.counts.pop(name, None)
+                self.hit_stats.forget(trigger)
+        for trigger in added:
+            self.names.setdefault(trigger.name.lower(), trigger)
+        self.triggers = triggers
+        self.saved = indexes["names"]
+        self.load_failed = False
+        if added or edited or removed:
+            print("Trigger: reloaded triggers.json ({} added, {} edited, "
+                  "{} removed)".format(len(added), edited, len(removed)))
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.observe("trigger_reload_seconds",
+                            time.perf_counter() - start)
+
+    def get_metrics(self):
+        metrics = self.bot.get_cog("Metrics")
+        if metrics is not None and metrics.enabled:
+            return metrics
+        return None
 
     def __unload(self):
+        dispatch = self.bot.get_cog("Dispatch")
+        if dispatch is not None:
+            dispatch.unregister(self)
+        self.watch_task.cancel()
         self.stats_task.cancel()
-        self.save_triggers()
+        self.load_task.cancel()
+        self.store.close(self.counts, self.count_seeds(self.counts))
+        if not self.ready.is_set():
+            return
+        if (self.save_pending or self.save_failed) and not self.load_failed:
+            merge_triggers([t.export() for t in self.triggers], self.saved,
+                           self.triggers_stat)
+        dataIO.save_json(self.stats_path, self.hit_stats.export())
+
+
+def stats_path(bot):
+    """Each shard keeps the hit stats of its own servers"""
+    shard_id = getattr(bot, "shard_id", None)
+    if shard_id is None:
+        return STATS_PATH
+    return SHARD_STATS_PATH.format(shard_id)
+
+
+def read_stats(path):
+    if not os.path.exists(path): # A new shard
+        return {}
+    return dataIO.load_json(path)
+
+
+def read_triggers():
+    """Returns triggers.json's stat, the triggers and their indexes
+
+    The triggers come from the snapshot when it's still valid, which is
+    faster to load than the JSON file. triggers.json stays the source of
+    truth: the snapshot is only used if it was made from a file with the
+    same mtime and size, or failing that, the same hash"""
+    file_stat = stat_triggers()
+    snapshot = read_snapshot()
+    if snapshot is not None and snapshot["stat"] == file_stat:
+        return file_stat, snapshot["triggers"], snapshot["indexes"]
+    file_stat, digest, triggers = read_triggers_file()
+    if snapshot is not None and snapshot["hash"] == digest:
+        triggers, indexes = snapshot["triggers"], snapshot["indexes"]
+    else:
+        indexes = build_indexes(triggers)
+    write_snapshot(file_stat, digest, triggers, indexes)
+    return file_stat, triggers, indexes
+
+
+def read_edited_triggers():
+    file_stat, digest, triggers = read_triggers_file()
+    indexes = build_indexes(triggers)
+    write_snapshot(file_stat, digest, triggers, indexes)
+    return file_stat, triggers, indexes
+
+
+def read_triggers_file():
+    """Returns triggers.json's stat, hash and triggers from a single read"""
+    with open(TRIGGERS_PATH, "rb") as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    triggers = json.loads(data.decode("utf-8"))
+    return (st.st_mtime, st.st_size), hashlib.sha1(data).hexdigest(), triggers
+
+
+def merge_triggers(triggers, saved, file_stat):
+    """Saves the triggers without undoing the edits of other shards
+
+    The shards save one at a time. If triggers.json was written by
+    another one since it was last read, only the triggers edited,
+    added or removed here since then are applied to the file's. Returns
+    the file's new stat, the triggers saved and their indexes"""
+    with TriggersLock():
+        current_stat = stat_triggers()
+        if current_stat is not None and current_stat != file_stat:
+            current = read_triggers_file()[2]
+            triggers = merge_entries(triggers, saved, current)
+        file_stat, indexes = save_triggers_file(triggers)
+    return file_stat, triggers, indexes
+
+
+def merge_entries(triggers, saved, current):
+    """Applies the changes from saved to triggers on top of current
+
+    saved maps the lowercase names to the triggers as last read. Those
+    are exported again to be compared with the same keys and defaults.
+    The counters are left out, they change on each fire"""
+    local = {}
+    for data in triggers:
+        name = data["name"].lower()
+        base = saved.get(name)
+        if base is not None:
+            base = TriggerObj(**base).export()
+        if base is None or not same_definition(base, data):
+            local[name] = data
+    removed = set(saved) - {data["name"].lower() for data in triggers}
+    merged = []
+    for data in current:
+        try:
+            name = data["name"].lower()
+        except (TypeError, KeyError, AttributeError):
+            name = None # Kept as it is, the watcher will refuse it
+        if name in removed:
+            continue
+        merged.append(local.pop(name, data))
+    merged.extend(local.values())
+    return merged
+
+
+def same_definition(a, b):
+    return ({k: v for k, v in a.items() if k != "triggered"} ==
+            {k: v for k, v in b.items() if k != "triggered"})
+
+
+class TriggersLock:
+    """Lets one shard at a time read, merge and write triggers.json
+
+    It's a write transaction on a small SQLite database, so it's also
+    released if the process dies while holding it"""
+
+    def __enter__(self):
+        self.db = sqlite3.connect(LOCK_PATH, timeout=60,
+                                  isolation_level=None)
+        self.db.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, *exc):
+        self.db.execute("ROLLBACK")
+        self.db.close()
+
+
+def save_triggers_file(triggers):
+    """Writes the triggers, returns triggers.json's new stat and indexes
+
+    The JSON is serialized once, in the same format as dataIO, and the
+    snapshot is hashed from those bytes instead of reading the file back"""
+    data = json.dumps(triggers, indent=4, sort_keys=True,
+                      separators=(",", " : ")).encode("utf-8")
+    tmp = tmp_path(TRIGGERS_PATH)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            st = os.fstat(f.fileno())
+        os.replace(tmp, TRIGGERS_PATH)
+    except:
+        remove_tmp(tmp)
+        raise
+    file_stat = (st.st_mtime, st.st_size)
+    indexes = build_indexes(triggers)
+    digest = hashlib.sha1(data).hexdigest()
+    write_snapshot(file_stat, digest, triggers, indexes)
+    return file_stat, indexes
+
+
+def index_entries(triggers):
+    """Maps the lowercase names to the triggers' JSON data"""
+    index = {}
+    for data in triggers:
+        index.setdefault(data["name"].lower(), data)
+    return index
+
+
+def stat_triggers():
+    try:
+        st = os.stat(TRIGGERS_PATH)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def build_indexes(triggers):
+    """The indexes saved in the snapshot with the triggers
+
+    names maps the lowercase names to the triggers' JSON data, lowered
+    has each trigger's lowercase phrase, so that neither has to be
+    computed at startup"""
+    lowered = []
+    for data in triggers:
+        triggered_by = data.get("triggered_by")
+        if isinstance(triggered_by, str):
+            lowered.append(triggered_by.lower())
+        else:
+            lowered.append(None)
+    return {"names": index_entries(triggers), "lowered": lowered}
+
+
+def read_snapshot():
+    """Returns the snapshot, or None if it's missing or of another version"""
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot["version"] == SNAPSHOT_VERSION:
+            return snapshot
+    except Exception: # Missing, corrupted or made by another version
+        pass
+    return None
+
+
+def write_snapshot(file_stat, digest, triggers, indexes):
+    snapshot = {"version": SNAPSHOT_VERSION, "stat": file_stat,
+                "hash": digest, "triggers": triggers, "indexes": indexes}
+    tmp = tmp_path(SNAPSHOT_PATH)
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, SNAPSHOT_PATH)
+    except OSError as e:
+        remove_tmp(tmp)
+        print("Couldn't write the triggers' snapshot: {}".format(e))
+
+
+def tmp_path(path):
+    """A temporary file of its own for each process and thread, since
+    the shards write the same files"""
+    return "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
+def remove_tmp(tmp):
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+
+def write_jsonl(path, triggers):
+    tmp = tmp_path(path)
+    with open(tmp, "w", encoding="utf-8") as f:
+        for trigger in triggers:
+            f.write(json.dumps(trigger))
+            f.write("\n")
+    os.replace(tmp, path)
+
+
+def read_jsonl(path, names, owner):
+    """Reads triggers from a file with one JSON trigger per line
+
+    The file is validated and checked for duplicate names in a single
+    pass, without loading it whole. Returns the triggers, a list of
+    errors and how many duplicates were skipped"""
+    triggers = []
+    errors = []
+    duplicates = 0
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                validate_trigger(data)
+            except (ValueError, TypeError) as e:
+                errors.append("Line {}: {}".format(n, e))
+                continue
+            name = data["name"].lower()
+            if name in names:
+                duplicates += 1
+                continue
+            names.add(name)
+            if data.get("owner") is None:
+                data["owner"] = owner
+            data.pop("bot", None)
+            data.pop("storage", None)
+            triggers.append(TriggerObj(**data))
+    return triggers, errors, duplicates
+
+
+def validate_trigger(data):
+    if not isinstance(data, dict):
+        raise TypeError("not an object")
+    for key in ("name", "triggered_by"):
+        if not isinstance(data.get(key), str) or not data[key]:
+            raise ValueError("{} must be a non empty string".format(key))
+    responses = data.get("responses", [])
+    if (not isinstance(responses, list) or
+            not all(isinstance(r, str) for r in responses)):
+        raise ValueError("responses must be a list of strings")
+    if data.get("type", "all") not in ("all", "random"):
+        raise ValueError("type must be all or random")
+    for key in ("owner", "server"):
+        if not isinstance(data.get(key), (str, type(None))):
+            raise ValueError("{} must be an id".format(key))
+    channels = data.get("channels", {})
+    if (not isinstance(channels, dict) or
+            not all(isinstance(c, list) for c in channels.values())):
+        raise ValueError("channels must map server ids to lists")
+    for key in ("case_sensitive", "regex", "active"):
+        if not isinstance(data.get(key, False), bool):
+            raise ValueError("{} must be true or false".format(key))
+    for key in ("cooldown", "triggered"):
+        value = data.get(key, 1)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError("{} must be a positive integer".format(key))
+    if data.get("regex"):
+        try:
+            re.compile(data["triggered_by"])
+        except re.error as e:
+            raise ValueError("invalid regex: {}".format(e))
+
+
+class ResponseStore:
+    """SQLite database of the responses of triggers in disk mode
+
+    The queries run on a dedicated thread, in the order they're made, so
+    they never hold up the event loop. The number of responses of each
+    trigger is kept in memory, so it's known without a query.
+
+    It also has the triggers' fire counts. The database runs in WAL mode
+    and is shared by the shards: each adds its fires to the counts, and
+    responses are appended at an index picked by the database"""
+
+    def __init__(self, path, loop):
+        self.path = path
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = None
+        self.lengths = {} # Trigger name -> number of responses
+        self.edits = 0 # Queued edits of the responses
+
+    def run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30,
+                                      check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                            "(trigger TEXT, idx INTEGER, body TEXT, "
+                            "PRIMARY KEY (trigger, idx))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS counts "
+                            "(trigger TEXT PRIMARY KEY, triggered INTEGER)")
+        return self.db
+
+    async def load(self, counts):
+        """Returns the fire counts, counts are the ones to start from
+        for the triggers that have none"""
+        self.lengths = await self.run(self._count)
+        return await self.run(self._seed_counts, counts)
+
+    async def sync(self, counts, seeds):
+        """Adds the fires to the counts and returns the new totals, seeds
+        are the counts to start from for the triggers that have none"""
+        edits = self.edits
+        totals, lengths = await self.run(self._sync, counts, seeds)
+        if edits == self.edits: # Otherwise ours aren't counted yet
+            self.lengths = lengths
+        return totals
+
+    def forget_count(self, name):
+        return self.run(self._forget_count, name)
+
+    def get(self, trigger, idx):
+        return self.run(self._get, trigger, idx)
+
+    def all(self, trigger):
+        return self.run(self._all, trigger)
+
+    def search(self, terms):
+        """Returns the names of the triggers with a response containing
+        terms, compared in lowercase"""
+        return self.run(self._search, terms)
+
+    def insert(self, trigger, body):
+        self.lengths[trigger] = self.lengths.get(trigger, 0) + 1
+        self.edits += 1
+        return self.run(self._insert, trigger, body)
+
+    def delete(self, trigger, idx):
+        self.lengths[trigger] -= 1
+        self.edits += 1
+        return self.run(self._delete, trigger, idx)
+
+    def replace(self, trigger, responses):
+        responses = list(responses)
+        self.edits += 1
+        if responses:
+            self.lengths[trigger] = len(responses)
+        else:
+            self.lengths.pop(trigger, None)
+        return self.run(self._replace, trigger, responses)
+
+    def drop(self, trigger):
+        return self.replace(trigger, [])
+
+    def close(self, counts, seeds):
+        """Closes the database once the pending queries are done and the
+        last fires are counted"""
+        if counts:
+            self.executor.submit(self._sync, dict(counts), seeds)
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait=True)
+
+    # Run on the store's thread
+
+    def _count(self):
+        cursor = self.connect().execute("SELECT trigger, COUNT(*) FROM "
+                                        "responses GROUP BY trigger")
+        return dict(cursor.fetchall())
+
+    def _get(self, trigger, idx):
+        cursor = self.connect().execute("SELECT body FROM responses "
+                                        "WHERE trigger = ? AND idx = ?",
+                                        (trigger, idx))
+        return cursor.fetchone()[0]
+
+    def _all(self, trigger):
+        cursor = self.connect().execute("SELECT body FROM responses "
+                                        "WHERE trigger = ? ORDER BY idx",
+                                        (trigger,))
+        return [row[0] for row in cursor]
+
+    def _search(self, terms):
+        cursor = self.connect().execute("SELECT trigger, body FROM responses")
+        return {trigger for trigger, body in cursor if terms in body.lower()}
+
+    def _insert(self, trigger, body):
+        db = self.connect()
+        with db:
+            db.execute("INSERT INTO responses SELECT ?, "
+                       "COALESCE(MAX(idx) + 1, 0), ? FROM responses "
+                       "WHERE trigger = ?", (trigger, body, trigger))
+
+    def _delete(self, trigger, idx):
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM responses "
+                       "WHERE trigger = ? AND idx = ?", (trigger, idx))
+            # Shifted in two steps to not clash with the primary key
+            db.execute("UPDATE responses SET idx = -idx "
+                       "WHERE trigger = ? AND idx > ?", (trigger, idx))
+            db.execute("UPDATE responses SET idx = -idx - 1 "
+                       "WHERE trigger = ? AND idx < 0", (trigger,))
+
+    def _replace(self, trigger, responses):
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM responses WHERE trigger = ?", (trigger,))
+            db.executemany("INSERT INTO responses VALUES (?, ?, ?)",
+                           ((trigger, i, r) for i, r in enumerate(responses)))
+
+    def _seed_counts(self, counts):
+        db = self.connect()
+        with db:
+            db.executemany("INSERT OR IGNORE INTO counts VALUES (?, ?)",
+                           counts.items())
+        return dict(db.execute("SELECT trigger, triggered FROM counts"))
+
+    def _sync(self, counts, seeds):
+        db = self.connect()
+        with db:
+            db.executemany("INSERT OR IGNORE INTO counts VALUES (?, ?)",
+                           ((name, seeds.get(name, 0)) for name in counts))
+            db.executemany("UPDATE counts SET triggered = triggered + ? "
+                           "WHERE trigger = ?",
+                           ((n, name) for name, n in counts.items()))
+        totals = dict(db.execute("SELECT trigger, triggered FROM counts"))
+        return totals, self._count()
+
+    def _forget_count(self, name):
+        db = self.connect()
+        with db:
+            db.execute("DELETE FROM counts WHERE trigger = ?", (name,))
+
+    def _close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class DiskResponses:
+    """List-like view of a trigger's responses in a ResponseStore
+
+    Its length comes from the store's memory. The last HOT_RESPONSES
+    responses read are kept, so random picks don't load the whole list"""
+
+    def __init__(self, store, trigger):
+        self.store = store
+        self.trigger = trigger
+        self.hot = OrderedDict()
+        self.version = 0 # Bumped when the indexes shift
+
+    def __len__(self):
+        return self.store.lengths.get(self.trigger, 0)
+
+    async def get(self, i):
+        i = self._index(i)
+        body = self.hot.get(i)
+        if body is not None:
+            self.hot.move_to_end(i)
+            return body
+        version = self.version
+        body = await self.store.get(self.trigger, i)
+        if version == self.version:
+            self.hot[i] = body
+            if len(self.hot) > HOT_RESPONSES:
+                self.hot.popitem(last=False)
+        return body
+
+    async def pick(self):
+        return await self.get(randrange(len(self)))
+
+    async def all(self):
+        return await self.store.all(self.trigger)
+
+    async def append(self, body):
+        await self.store.insert(self.trigger, body)
+
+    async def delete(self, i):
+        i = self._index(i)
+        self.version += 1
+        self.hot.clear()
+        await self.store.delete(self.trigger, i)
+
+    def _index(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("response index out of range")
+        return i
+
+
+class TokenBucket:
+    """Holds up to `responses` tokens, refilled over `seconds`"""
+
+    __slots__ = ("rate", "capacity", "per_second", "tokens", "last")
+
+    def __init__(self, rate, now):
+        responses, seconds = rate
+        self.rate = tuple(rate)
+        self.capacity = responses
+        self.per_second = responses / seconds
+        self.tokens = responses
+        self.last = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.per_second)
+        self.last = now
+
+    def full(self, now):
+        return (self.tokens + (now - self.last) * self.per_second >=
+                self.capacity)
+
+
+class HitRing:
+    """Ring buffer counting hits in fixed width time buckets"""
+
+    __slots__ = ("width", "buckets", "last")
+
+    def __init__(self, width, size, last=0, buckets=None):
+        self.width = width
+        self.buckets = buckets if buckets is not None else [0] * size
+        self.last = last
+
+    def advance(self, now):
+        """Zeroes the buckets that went by since the last hit"""
+        slot = int(now // self.width)
+        gap = slot - self.last
+        if gap > 0:
+            size = len(self.buckets)
+            for i in range(1, min(gap, size) + 1):
+                self.buckets[(self.last + i) % size] = 0
+            self.last = slot
+        return slot
+
+    def add(self, now, n=1):
+        slot = self.advance(now)
+        self.buckets[slot % len(self.buckets)] += n
+
+    def total(self, now):
+        self.advance(now)
+        return sum(self.buckets)
+
+    def export(self):
+        return [self.last, list(self.buckets)]
+
+
+class HitStats:
+    """Time bucketed hits per trigger and per server
+
+    Each trigger that has been fired gets a ring buffer per period and
+    a count of the channels it's fired in, trimmed to the busiest ones.
+    Servers only get the ring buffers"""
+
+    def __init__(self, data):
+        self.triggers = {}
+        self.servers = {}
+        for name, stats in data.get("triggers", {}).items():
+            self.triggers[name] = {"rings": self.load_rings(stats["rings"]),
+                                   "channels": stats["channels"]}
+        for server_id, rings in data.get("servers", {}).items():
+            self.servers[server_id] = self.load_rings(rings)
+
+    def load_rings(self, data=None):
+        rings = {}
+        for period, (width, size) in STATS_PERIODS.items():
+            if data and period in data:
+                last, buckets = data[period]
+                rings[period] = HitRing(width, size, last, buckets)
+            else:
+                rings[period] = HitRing(width, size)
+        return rings
+
+    def hit(self, trigger, message, now):
+        stats = self.triggers.get(trigger.name.lower())
+        if stats is None:
+            stats = self.triggers[trigger.name.lower()] = {
+                "rings": self.load_rings(), "channels": {}}
+        for ring in stats["rings"].values():
+            ring.add(now)
+        channels = stats["channels"]
+        channels[message.channel.id] = channels.get(message.channel.id, 0) + 1
+        if len(channels) > MAX_STATS_CHANNELS * 2:
+            busiest = sorted(channels.items(), key=lambda c: c[1],
+                             reverse=True)[:MAX_STATS_CHANNELS]
+            stats["channels"] = dict(busiest)
+        server_rings = self.servers.get(message.server.id)
+        if server_rings is None:
+            server_rings = self.servers[message.server.id] = self.load_rings()
+        for ring in server_rings.values():
+            ring.add(now)
+
+    def hits(self, trigger, period, now=None):
+        stats = self.triggers.get(trigger.name.lower())
+        if stats is None:
+            return 0
+        return stats["rings"][period].total(now or time.time())
+
+    def server_hits(self, server_id, period, now=None):
+        rings = self.servers.get(server_id)
+        if rings is None:
+            return 0
+        return rings[period].total(now or time.time())
+
+    def top(self, triggers, period, n=10):
+        now = time.time()
+        hits = [(t, self.hits(t, period, now)) for t in triggers]
+        hits = [h for h in hits if h[1]]
+        return sorted(hits, key=lambda h: h[1], reverse=True)[:n]
+
+    def channels(self, trigger):
+        stats = self.triggers.get(trigger.name.lower())
+        if stats is None:
+            return []
+        return sorted(stats["channels"].items(), key=lambda c: c[1],
+                      reverse=True)[:MAX_STATS_CHANNELS]
+
+    def forget(self, trigger):
+        self.triggers.pop(trigger.name.lower(), None)
+
+    def export(self):
+        def export_rings(rings):
+            return {p: r.export() for p, r in rings.items()}
+        triggers = {name: {"rings": export_rings(stats["rings"]),
+                           "channels": dict(stats["channels"])}
+                    for name, stats in self.triggers.items()}
+        servers = {server_id: export_rings(rings)
+                   for server_id, rings in self.servers.items()}
+        return {"triggers": triggers, "servers": servers}
+
+
+class FileCache:
+    """LRU cache of file contents, bounded by their total size
+
+    Entries are keyed by path and mtime, so an edited file is read again
+    once its trigger's file responses are resolved again"""
+
+    def __init__(self, max_size, max_entry):
+        self.max_size = max_size
+        self.max_entry = max_entry
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, mtime):
+        key = (path, mtime)
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+        self.misses += 1
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) <= self.max_entry:
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return data
 
 
 class TriggerObj:
@@ -562,9 +2000,16 @@ class TriggerObj:
         self.name = kwargs.get("name")
         self.owner = kwargs.get("owner")
         self.triggered_by = kwargs.get("triggered_by")
-        self.responses = kwargs.get("responses", [])
+        self.store = kwargs.get("store")
+        self.storage = kwargs.get("storage", "memory") # Types: memory, disk
+        if self.storage == "disk":
+            self.responses = DiskResponses(self.store, self.name)
+        else:
+            # Copied, the data it's made from is compared to on saves
+            self.responses = list(kwargs.get("responses", []))
         self.server = kwargs.get("server") # if it's None, the trigger will be implicitly global
-        self.channels = kwargs.get("channels", {})
+        self.channels = {k: list(v)
+                         for k, v in kwargs.get("channels", {}).items()}
         self.type = kwargs.get("type", "all") # Type of payload. Types: all, random
         self.case_sensitive = kwargs.get("case_sensitive", False)
         self.regex = kwargs.get("regex", False)
@@ -572,17 +2017,77 @@ class TriggerObj:
         self.triggered = kwargs.get("triggered", 0) # Counter
         self.last_triggered = datetime.datetime(1970, 2, 6) # Initialized
         self.active = kwargs.get("active", True)
+        self.cache = {} # Rendered responses
+        self.files = {} # Resolved file responses
+        self.lowered = (None, None) # triggered_by, triggered_by.lower()
 
     def export(self):
         data = self.__dict__.copy()
         del data["bot"]
+        del data["store"]
         del data["last_triggered"]
+        del data["cache"]
+        del data["files"]
+        del data["lowered"]
+        # Copied so that they can be written from another thread
+        if self.storage == "disk":
+            del data["responses"]
+        else:
+            data["responses"] = list(self.responses)
+        data["channels"] = {k: list(v) for k, v in self.channels.items()}
         return data
 
-    def check(self, msg):
+    async def get_responses(self):
+        """Returns a copy of the responses, wherever they're kept"""
+        if self.storage == "disk":
+            return await self.responses.all()
+        return list(self.responses)
+
+    async def add_response(self, body):
+        if self.storage == "disk":
+            await self.responses.append(body)
+        else:
+            self.responses.append(body)
+
+    async def delete_response(self, i):
+        if self.storage == "disk":
+            await self.responses.delete(i)
+        else:
+            del self.responses[i]
+
+    def edited(self):
+        """Drops what was cached from the responses"""
+        self.cache.clear()
+        self.files.clear()
+
+    def reload(self, data):
+        """Replaces the trigger's settings, keeping its cooldown and counter"""
+        last_triggered = self.last_triggered
+        triggered = self.triggered
+        self.__init__(bot=self.bot, store=self.store, **data)
+        self.last_triggered = last_triggered
+        self.triggered = max(self.triggered, triggered)
+
+    def check(self, msg, lowered=None):
+        """Checks whether the message fires the trigger
+
+        If it does, the trigger's cooldown starts"""
+        if not self.matches(msg, lowered) or self.on_cooldown():
+            return False
+        self.last_triggered = datetime.datetime.now()
+        return True
+
+    def matches(self, msg, lowered=None):
+        """Checks whether the message matches the trigger, cooldown aside
+
+        lowered is the message's content in lowercase, so that it can be
+        computed once per message rather than once per trigger"""
         if not self.active:
             return False
 
+        if (self.server == msg.server.id or self.server is None) is False:
+            return False
+
         channels = self.channels.get(msg.server.id, [])
         if channels:
             if msg.channel.id not in channels:
@@ -591,12 +2096,11 @@ class TriggerObj:
         content = msg.content
         triggered_by = self.triggered_by
 
-        if (self.server == msg.server.id or self.server is None) is False:
-            return False
-
         if not self.case_sensitive:
-            triggered_by = triggered_by.lower()
-            content = content.lower()
+            if self.lowered[0] is not triggered_by:
+                self.lowered = (triggered_by, triggered_by.lower())
+            triggered_by = self.lowered[1]
+            content = lowered if lowered is not None else content.lower()
 
         if not self.regex:
             if triggered_by not in content:
@@ -606,35 +2110,50 @@ class TriggerObj:
             if not found:
                 return False
 
-        timestamp = datetime.datetime.now()
-        passed = (timestamp - self.last_triggered).seconds
-        if passed > self.cooldown:
-            self.last_triggered = timestamp
-            return True
-        else:
+        return True
+
+    def on_cooldown(self):
+        passed = (datetime.datetime.now() - self.last_triggered).seconds
+        return passed <= self.cooldown
+
+    def fired_with(self, other):
+        """Whether every message matching other's phrase matches this one's
+
+        Only plain phrases are compared, regexes never overlap"""
+        if self.regex or other.regex:
             return False
+        if self.case_sensitive:
+            if not other.case_sensitive:
+                return False
+            return self.triggered_by in other.triggered_by
+        return self.triggered_by.lower() in other.triggered_by.lower()
 
-    def payload(self):
+    async def payload(self):
         if self.responses:
             self.triggered += 1
         if self.type == "all":
+            if self.storage == "disk":
+                return await self.responses.all()
             return self.responses
         elif self.type == "random":
-            if self.responses:
-                return [choice(self.responses)]
-            else:
+            if not self.responses:
                 return []
+            elif self.storage == "disk":
+                return [await self.responses.pick()]
+            else:
+                return [choice(self.responses)]
         else:
             raise RuntimeError("Invalid trigger type.")
 
-    def can_edit(self, user):
+    def can_edit(self, user, is_admin=None):
         settings = self.bot.settings
         server = user.server
-        admin_role = settings.get_server_admin(server)
         # Using the is_owner_check would be better but I don't always have
         # context here, nor I feel like mocking it
         is_owner = user.id == settings.owner or user.id in settings.co_owners
-        is_admin = discord.utils.get(user.roles, name=admin_role) is not None
+        if is_admin is None:
+            admin_role = settings.get_server_admin(server)
+            is_admin = discord.utils.get(user.roles, name=admin_role) is not None
         is_trigger_owner = user.id == self.owner
         trigger_is_global = self.server is None
         if trigger_is_global:
@@ -652,13 +2171,23 @@ def check_folders():
 
 
 def check_files():
-    f = "data/trigger/triggers.json"
+    f = TRIGGERS_PATH
     if not dataIO.is_valid_json(f):
         print("Creating empty triggers.json...")
         dataIO.save_json(f, [])
+    if not dataIO.is_valid_json(SETTINGS_PATH):
+        print("Creating empty settings.json...")
+        dataIO.save_json(SETTINGS_PATH, {})
+    if not dataIO.is_valid_json(STATS_PATH):
+        print("Creating empty stats.json...")
+        dataIO.save_json(STATS_PATH, {"triggers": {}, "servers": {}})
 
 
 def setup(bot):
     check_folders()
     check_files()
-    bot.add_cog(Trigger(bot))
+    n = Trigger(bot)
+    bot.add_cog(n)
+    dispatch = bot.get_cog("Dispatch")
+    if dispatch is not None:
+        dispatch.register(n)